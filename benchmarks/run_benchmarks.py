@@ -0,0 +1,256 @@
+"""
+Benchmark suite for the preprocessing stage and the feature extractors.
+
+Synthetic 64x64 cell-like images are generated (a red cell-body channel used to build the masks, and a green
+protein channel with a class-dependent texture), then each stage is timed in its own child process, so that the
+peak resident memory of a stage is not inflated by the stages run before it. For each stage the fit and transform
+times, the throughput (images/s), the per-image latency and the peak RSS are written to a JSON results file, and
+optionally compared against a stored baseline file.
+
+Usage:
+    python benchmarks/run_benchmarks.py --n 2000
+    python benchmarks/run_benchmarks.py --n 2000 --stages haralick swt --save-baseline benchmarks/baseline.json
+    python benchmarks/run_benchmarks.py --n 2000 --baseline benchmarks/baseline.json --fail-on-regression
+
+LDB_FeatureExtractor needs Julia (via PyJulia). When it is not available, the ldb stage is reported as skipped.
+Everything else runs offline on CPU.
+"""
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import resource
+import sys
+import time
+import numpy as np
+
+# make the codes package importable when the script is run from anywhere
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+STAGES = ("preprocessing", "haralick", "intensity", "swt", "sift", "scattering", "numpy_ldb", "ldb")
+
+def synthetic_images(n, seed=0, size=64, n_classes=3):
+    """
+    Generate n synthetic BGR cell images with shape (size, size, 3) and their labels. The red channel holds an
+    elliptical cell body on a noisy background. The green channel holds the protein signal inside the cell:
+    diffuse (class 0), punctate (class 1) or concentrated at the cell border (class 2).
+    """
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[:size, :size].astype(np.float64)
+    X = np.empty((n, size, size, 3), dtype=np.uint8)
+    y = rng.integers(0, n_classes, n)
+    for i in range(n):
+        cy, cx = rng.uniform(0.35, 0.65, 2) * size
+        ry, rx = rng.uniform(0.15, 0.3, 2) * size
+        theta = rng.uniform(0, np.pi)
+        u = ((xx - cx) * np.cos(theta) + (yy - cy) * np.sin(theta)) / rx
+        v = (-(xx - cx) * np.sin(theta) + (yy - cy) * np.cos(theta)) / ry
+        r = np.sqrt(u ** 2 + v ** 2)
+        body = np.clip(1.2 - r, 0, 1)
+        red = 40 + 150 * body + rng.normal(0, 8, (size, size))
+        if y[i] == 0:
+            green = 90 * body
+        elif y[i] == 1:
+            spots = np.zeros((size, size))
+            for (sy, sx) in rng.uniform(-0.6, 0.6, (6, 2)):
+                spots += np.exp(-((u - sx) ** 2 + (v - sy) ** 2) / 0.02)
+            green = 160 * np.clip(spots, 0, 1) * (r < 1)
+        else:
+            green = 140 * np.exp(-((r - 0.9) ** 2) / 0.02)
+        green = green + rng.normal(0, 6, (size, size)) + 10
+        X[i, ..., 0] = 0
+        X[i, ..., 1] = np.clip(green, 0, 255)
+        X[i, ..., 2] = np.clip(red, 0, 255)
+    return X, y
+
+def _peak_rss_mb():
+    """
+    Peak resident memory of the current process, in MB (ru_maxrss is in kB on Linux, in bytes on macOS).
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+def _timed(func, *args):
+    """
+    Run func(*args) and return (elapsed seconds, result).
+    """
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+def _run_stage(stage, n, seed, n_jobs):
+    """
+    Run one stage in the current (child) process and return its measurements. The input data is generated and
+    preprocessed before the timers start, except for the preprocessing stage itself.
+    """
+    from codes.image_preprocessing import preprocessing_pipeline
+    X, y = synthetic_images(n, seed)
+    pipeline = preprocessing_pipeline(outputs=("normalized", "mask"), n_jobs=n_jobs)
+    if stage == "preprocessing":
+        rss_before = _peak_rss_mb()
+        fit_s = 0.
+        transform_s, _ = _timed(pipeline.transform, X)
+        return fit_s, transform_s, rss_before
+    prep = pipeline.transform(X)
+    images, masks = prep["normalized"], prep["mask"]
+    del X, prep
+    if stage == "haralick":
+        from codes.haralick import haralick
+        extractor, args = haralick([1, 2], n_jobs=n_jobs), (images,)
+    elif stage == "intensity":
+        from codes.intensity import IntensityMeasure
+        extractor, args = IntensityMeasure(masks), (images,)
+    elif stage == "swt":
+        from codes.swt import SWT_FeatureExtractor
+        extractor, args = SWT_FeatureExtractor(n_levels=2), (images,)
+    elif stage == "sift":
+        from codes.sift import SIFT_FeatureExtractor
+        extractor, args = SIFT_FeatureExtractor(kmeans_nclusters=20, n_jobs=n_jobs, random_state=seed), (list(images),)
+    elif stage == "scattering":
+        from codes.scattering_transform import scattering_transform
+        extractor = scattering_transform(2, images.shape[1:], n_jobs=n_jobs, dtype=np.float32)
+        args = (images.astype(np.float32),)
+    elif stage == "numpy_ldb":
+        from codes.ldb import NumpyLDB_FeatureExtractor
+        extractor, args = NumpyLDB_FeatureExtractor(n_features=100, n_jobs=n_jobs), (images.astype(np.float64),)
+    elif stage == "ldb":
+        from codes.ldb import LDB_FeatureExtractor
+        extractor, args = LDB_FeatureExtractor(n_features=100), (images.astype(np.float64),)
+    else:
+        raise ValueError("Unknown stage %s." % stage)
+    rss_before = _peak_rss_mb()
+    if stage in ("numpy_ldb", "ldb"):
+        fit_s, _ = _timed(extractor.fit, *args, y)
+    else:
+        fit_s, _ = _timed(extractor.fit, *args)
+    transform_s, _ = _timed(extractor.transform, *args)
+    return fit_s, transform_s, rss_before
+
+def _stage_worker(stage, n, seed, n_jobs, queue):
+    """
+    Child process entry point: run the stage and send its measurements (or the error) back through the queue.
+    """
+    if stage == "ldb":
+        try:
+            from codes.ldb import julia_main
+            julia_main()
+        except Exception as e:
+            queue.put({"status": "skipped", "reason": "Julia/PyJulia is not available (%s)" % type(e).__name__})
+            return None
+    try:
+        fit_s, transform_s, rss_before = _run_stage(stage, n, seed, n_jobs)
+        queue.put({"status": "ok",
+                   "n_images": n,
+                   "fit_s": fit_s,
+                   "transform_s": transform_s,
+                   "total_s": fit_s + transform_s,
+                   "images_per_s": n / transform_s if transform_s > 0 else None,
+                   "latency_ms_per_image": 1000 * transform_s / n,
+                   "peak_rss_mb": _peak_rss_mb(),
+                   "input_rss_mb": rss_before})
+    except Exception as e:
+        queue.put({"status": "error", "error": "%s: %s" % (type(e).__name__, e)})
+
+def run_stage(stage, n, seed=0, n_jobs=1, repeat=1, timeout=None):
+    """
+    Run a stage `repeat` times, each in a fresh child process, and keep the fastest run.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    best = None
+    for _ in range(repeat):
+        results = ctx.Queue()
+        proc = ctx.Process(target=_stage_worker, args=(stage, n, seed, n_jobs, results))
+        proc.start()
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        result = None
+        while result is None:
+            try:
+                result = results.get(timeout=1)
+            except queue.Empty:
+                if not proc.is_alive():
+                    result = {"status": "error", "error": "crashed with exit code %s" % proc.exitcode}
+                elif deadline is not None and time.perf_counter() > deadline:
+                    proc.terminate()
+                    result = {"status": "error", "error": "timed out after %ss" % timeout}
+        proc.join()
+        if result["status"] != "ok":
+            return result
+        if best is None or result["total_s"] < best["total_s"]:
+            best = result
+    return best
+
+def compare(results, baseline, tolerance=0.1):
+    """
+    Compare the stage times with a baseline results dict. A stage regresses when its total time is more than
+    (1 + tolerance) times the baseline time.
+    :return: dict mapping each stage found in both to its time ratio and regression flag.
+    """
+    comparison = {}
+    for (stage, r) in results.items():
+        b = baseline.get("results", {}).get(stage)
+        if r.get("status") != "ok" or b is None or b.get("status") != "ok":
+            continue
+        ratio = r["total_s"] / b["total_s"] if b["total_s"] > 0 else None
+        comparison[stage] = {"baseline_total_s": b["total_s"],
+                             "ratio": ratio,
+                             "regression": ratio is not None and ratio > 1 + tolerance}
+    return comparison
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the preprocessing stage and the feature extractors.")
+    parser.add_argument("--n", type=int, default=1000, help="number of synthetic images (default 1000)")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic images")
+    parser.add_argument("--stages", nargs="+", default=list(STAGES), choices=STAGES, help="stages to run")
+    parser.add_argument("--n-jobs", type=int, default=1, help="n_jobs of the stages supporting it")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per stage, the fastest is kept")
+    parser.add_argument("--timeout", type=float, default=None, help="timeout of a stage run, in seconds")
+    parser.add_argument("--output", default=os.path.join(ROOT, "benchmarks", "results.json"),
+                        help="results file (JSON)")
+    parser.add_argument("--baseline", default=None, help="baseline results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed slowdown vs baseline (default 0.1)")
+    parser.add_argument("--save-baseline", default=None, help="also write the results to this baseline file")
+    parser.add_argument("--fail-on-regression", action="store_true", help="exit with status 1 on regressions")
+    args = parser.parse_args(argv)
+
+    results = {}
+    for stage in args.stages:
+        results[stage] = run_stage(stage, args.n, args.seed, args.n_jobs, args.repeat, args.timeout)
+        r = results[stage]
+        if r["status"] == "ok":
+            print("%-14s fit %8.3fs  transform %8.3fs  %10.1f img/s  %7.3f ms/img  peak RSS %8.1f MB"
+                  % (stage, r["fit_s"], r["transform_s"], r["images_per_s"] or 0., r["latency_ms_per_image"],
+                     r["peak_rss_mb"]))
+        else:
+            print("%-14s %s (%s)" % (stage, r["status"], r.get("reason") or r.get("error")))
+
+    report = {"meta": {"date": datetime.datetime.now().isoformat(timespec="seconds"),
+                       "n_images": args.n,
+                       "seed": args.seed,
+                       "n_jobs": args.n_jobs,
+                       "repeat": args.repeat,
+                       "python": platform.python_version(),
+                       "numpy": np.__version__,
+                       "platform": platform.platform(),
+                       "cpu_count": os.cpu_count()},
+              "results": results}
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["comparison"] = compare(results, json.load(f), args.tolerance)
+        for (stage, c) in report["comparison"].items():
+            ratio = "n/a" if c["ratio"] is None else "%.2fx" % c["ratio"]
+            print("%-14s %s baseline%s" % (stage, ratio, "  REGRESSION" if c["regression"] else ""))
+            if c["regression"]:
+                regressions.append(stage)
+    for path in filter(None, (args.output, args.save_baseline)):
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+    return 1 if regressions and args.fail_on_regression else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
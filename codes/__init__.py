@@ -1,23 +1,76 @@
-from .reorganize_data import reorganize_data
-from .utils import load_data, get_channel
-from .image_preprocessing import image_preprocessing
-from .ldb import LDB_FeatureExtractor
-from .haralick import haralick
-from .intensity import IntensityMeasure
-from .scattering_transform import scattering_transform
-from .sift import SIFT_FeatureExtractor
-from .surf import SURF_FeatureExtractor
-from .swt import SWT_FeatureExtractor
+import importlib
+import sys
+import types
+
+# submodule of each public name. Submodules are only imported on first access, so that importing the package does
+# not load heavy dependencies (in particular the Julia runtime of LDB_FeatureExtractor) that are not used.
+_submodules = {"reorganize_data": ".reorganize_data",
+               "load_data": ".utils",
+               "iter_data": ".utils",
+               "pack_data": ".utils",
+               "load_packed": ".utils",
+               "get_channel": ".utils",
+               "image_preprocessing": ".image_preprocessing",
+               "preprocessing_pipeline": ".image_preprocessing",
+               "LDB_FeatureExtractor": ".ldb",
+               "NumpyLDB_FeatureExtractor": ".ldb",
+               "haralick": ".haralick",
+               "IntensityMeasure": ".intensity",
+               "scattering_transform": ".scattering_transform",
+               "SIFT_FeatureExtractor": ".sift",
+               "SWT_FeatureExtractor": ".swt",
+               "FeatureCache": ".feature_cache",
+               "CachedExtractor": ".feature_cache",
+               "FeatureUnion": ".union",
+               "FeatureSweep": ".sweep",
+               "MemoryCollector": ".instrumentation",
+               "JSONLinesSink": ".instrumentation"}
 
 
 __all__ = ["reorganize_data", 
            "load_data", 
+           "iter_data",
+           "pack_data",
+           "load_packed",
            "get_channel", 
            "image_preprocessing", 
+           "preprocessing_pipeline",
            "LDB_FeatureExtractor",
+           "NumpyLDB_FeatureExtractor",
            "haralick",
            "IntensityMeasure",
            "scattering_transform",
            "SIFT_FeatureExtractor",
-           "SURF_FeatureExtractor",
-           "SWT_FeatureExtractor"]
\ No newline at end of file
+           "SWT_FeatureExtractor",
+           "FeatureCache",
+           "CachedExtractor",
+           "FeatureUnion",
+           "FeatureSweep",
+           "MemoryCollector",
+           "JSONLinesSink"]
+
+
+def __getattr__(name):
+    """
+    Import the submodule defining `name` on first access (PEP 562).
+    """
+    if name not in _submodules:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    value = getattr(importlib.import_module(_submodules[name], __name__), name)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
+
+class _LazyPackage(types.ModuleType):
+    """
+    Package module whose public names are never shadowed by the submodules defining them (e.g. the haralick
+    submodule and the haralick class), even when the submodules are imported after the package.
+    """
+    def __setattr__(self, name, value):
+        if name in _submodules and isinstance(value, types.ModuleType):
+            return None
+        super().__setattr__(name, value)
+
+sys.modules[__name__].__class__ = _LazyPackage
@@ -0,0 +1,277 @@
+import functools
+import hashlib
+import sqlite3
+import threading
+import time
+import numpy as np
+from .instrumentation import traced
+
+# attributes that determine the output of each extractor's transform
+CACHE_PARAMS = {
+    "haralick": ("distance", "ignore_zeros", "engine", "levels"),
+    "IntensityMeasure": (),
+    "SWT_FeatureExtractor": ("wt", "n_levels"),
+    "SIFT_FeatureExtractor": ("sift_nfeatures", "sift_nOctaveLayers", "sift_contrastThreshold",
+                              "sift_edgeThreshold", "sift_sigma", "kmeans_nclusters", "cluster_centers_"),
+    "scattering_transform": ("J", "shape", "L", "max_order", "dtype", "stats"),
+    # fitted best basis and ordering of the coefficients
+    "LDB_FeatureExtractor": ("wt", "tree", "order", "n_features", "dtype"),
+    "NumpyLDB_FeatureExtractor": ("wt", "levels", "order", "n_features", "dtype"),
+}
+
+def _update_hash(h, value):
+    """
+    Helper function: feed a parameter value into a hash object.
+    """
+    if isinstance(value, np.ndarray):
+        h.update(str((value.shape, value.dtype.str)).encode())
+        h.update(np.ascontiguousarray(value).tobytes())
+    elif hasattr(value, "cluster_centers_"):
+        # fitted k-means codebook
+        _update_hash(h, value.cluster_centers_)
+    elif isinstance(value, (list, tuple, range)):
+        h.update(b"[")
+        for v in value:
+            _update_hash(h, v)
+        h.update(b"]")
+    else:
+        h.update(repr(value).encode())
+    h.update(b";")
+
+def extractor_key(extractor):
+    """
+    Hash of the extractor type and of the parameters (and fitted attributes) that determine its features, listed in
+    CACHE_PARAMS.
+    """
+    name = type(extractor).__name__
+    assert name in CACHE_PARAMS, "No cache key is defined for %s, see CACHE_PARAMS." % name
+    h = hashlib.sha256(name.encode())
+    for p in CACHE_PARAMS[name]:
+        h.update(p.encode())
+        _update_hash(h, getattr(extractor, p, None))
+    return h.hexdigest()
+
+def image_key(prefix, img, mask=None):
+    """
+    Content hash of an image (and of its mask, if any) combined with the extractor key `prefix`.
+    """
+    h = hashlib.sha256(prefix.encode())
+    _update_hash(h, np.asarray(img))
+    if mask is not None:
+        _update_hash(h, np.asarray(mask))
+    return h.hexdigest()
+
+def _locked(method):
+    """
+    Helper decorator: run a FeatureCache method while holding the cache lock.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class FeatureCache:
+    """
+    Content-addressed on-disk store of feature rows. Each row is stored under the hash of the extractor parameters
+    and of the image bytes, in a single SQLite file. When the stored rows exceed max_bytes, the least recently used
+    rows are evicted. Hits, misses and the time spent computing the misses are counted, see report(). The cache can
+    be shared by threads: its SQLite connection and counters are guarded by a lock.
+    """
+    def __init__(self, path="feature_cache.sqlite", max_bytes=1 << 30):
+        """
+        Constructor of the feature cache.
+        :param path: (str) SQLite file storing the features. It is created if it does not exist.
+        :param max_bytes: (int) maximum total size of the stored feature rows.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS features (
+                             key TEXT PRIMARY KEY, value BLOB, size INTEGER, last_used REAL)""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS features_last_used ON features (last_used)")
+        self.conn.commit()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.compute_time = 0.
+
+    @_locked
+    def get_many(self, keys):
+        """
+        Look up feature rows.
+        :param keys: a list of keys.
+        :return: dict mapping the keys found in the cache to their feature rows (1D float64 arrays).
+        """
+        found = {}
+        unique = list(set(keys))
+        for start in range(0, len(unique), 500):
+            batch = unique[start:start + 500]
+            rows = self.conn.execute("SELECT key, value FROM features WHERE key IN (%s)" % ",".join("?" * len(batch)),
+                                     batch).fetchall()
+            for (k, v) in rows:
+                found[k] = np.frombuffer(v, dtype=np.float64)
+        if found:
+            now = time.time()
+            self.conn.executemany("UPDATE features SET last_used = ? WHERE key = ?", [(now, k) for k in found])
+            self.conn.commit()
+        return found
+
+    @_locked
+    def put_many(self, keys, rows):
+        """
+        Store feature rows, then evict the least recently used rows if the cache exceeds max_bytes.
+        :param keys: a list of keys.
+        :param rows: 2D array of feature rows, one per key.
+        """
+        now = time.time()
+        values = [(k, np.ascontiguousarray(r, dtype=np.float64).tobytes(), r.size * 8, now) for (k, r) in zip(keys, rows)]
+        self.conn.executemany("INSERT OR REPLACE INTO features VALUES (?, ?, ?, ?)", values)
+        self.conn.commit()
+        self.evict()
+
+    @_locked
+    def size(self):
+        """
+        Number of stored rows and their total size in bytes.
+        """
+        n, nbytes = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM features").fetchone()
+        return n, nbytes
+
+    @_locked
+    def evict(self):
+        """
+        Delete the least recently used rows until the stored rows fit within max_bytes.
+        """
+        n, nbytes = self.size()
+        if nbytes <= self.max_bytes:
+            return None
+        excess = nbytes - self.max_bytes
+        freed = 0
+        stale = []
+        for (k, size) in self.conn.execute("SELECT key, size FROM features ORDER BY last_used"):
+            if freed >= excess:
+                break
+            stale.append((k,))
+            freed += size
+        self.conn.executemany("DELETE FROM features WHERE key = ?", stale)
+        self.conn.commit()
+        self.evictions += len(stale)
+        return None
+
+    @_locked
+    def clear(self):
+        """
+        Delete all stored rows and reset the counters.
+        """
+        self.conn.execute("DELETE FROM features")
+        self.conn.commit()
+        self.hits = self.misses = self.evictions = 0
+        self.compute_time = 0.
+
+    @_locked
+    def report(self):
+        """
+        Summary of the cache usage since it was opened.
+        :return: dict with the number of hits, misses, hit rate, evictions, stored rows and bytes, the time spent
+        computing misses and the estimated computation time saved by the hits.
+        """
+        n, nbytes = self.size()
+        lookups = self.hits + self.misses
+        per_row = self.compute_time / self.misses if self.misses else 0.
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.,
+                "evictions": self.evictions,
+                "stored_rows": n,
+                "stored_bytes": nbytes,
+                "compute_time": self.compute_time,
+                "estimated_time_saved": self.hits * per_row}
+
+
+class CachedExtractor:
+    """
+    Wrapper around a feature extractor (haralick, IntensityMeasure, SWT_FeatureExtractor, SIFT_FeatureExtractor,
+    scattering_transform, LDB_FeatureExtractor or NumpyLDB_FeatureExtractor) whose transform only computes the
+    features of images missing from a FeatureCache.
+    """
+    def __init__(self, extractor, cache):
+        """
+        Constructor of the cached extractor.
+        :param extractor: a feature extractor object, of a type listed in CACHE_PARAMS.
+        :param cache: a FeatureCache object.
+        """
+        assert type(extractor).__name__ in CACHE_PARAMS, "No cache key is defined for %s." % type(extractor).__name__
+        self.extractor = extractor
+        self.cache = cache
+
+    def fit(self, X, *args, **kwargs):
+        """
+        Fit the wrapped extractor.
+        """
+        self.extractor.fit(X, *args, **kwargs)
+        return self
+
+    def _masks(self, X, mask):
+        """
+        Helper function: per-image masks of X, given to transform or else held by the wrapped extractor, if any.
+        """
+        if mask is None:
+            mask = getattr(self.extractor, "mask", None)
+        if mask is None or len(mask) == 0:
+            return None
+        assert len(mask) == len(X), "Number of source images and number of masks do not equal."
+        return mask
+
+    @traced("CachedExtractor.compute_misses")
+    def _compute(self, X, mask):
+        """
+        Helper function: compute the features of the images X with their masks (None without masks).
+        """
+        if mask is None:
+            return np.asarray(self.extractor.transform(X), dtype=np.float64)
+        return np.asarray(self.extractor.transform(X, mask), dtype=np.float64)
+
+    def transform(self, X, mask=None):
+        """
+        Extract features from the images X, reading cached rows and computing only the missing ones.
+        :param X: a list of single-channel arrays or an ndarray with shape (n_samples, H, W).
+        :param mask: masks of X, for the extractors whose transform takes masks (IntensityMeasure and
+        scattering_transform). Default to the masks given to the wrapped extractor's constructor, which must then be
+        the masks of X.
+        :return: ndarray with shape (n_samples, n_features)
+        """
+        if len(X) == 0:
+            return np.empty((0, 0))
+        prefix = extractor_key(self.extractor)
+        masks = self._masks(X, mask)
+        keys = [image_key(prefix, img, None if masks is None else masks[i]) for (i, img) in enumerate(X)]
+        found = self.cache.get_many(keys)
+        miss = [i for (i, k) in enumerate(keys) if k not in found]
+        with self.cache.lock:
+            self.cache.hits += len(X) - len(miss)
+            self.cache.misses += len(miss)
+        computed = None
+        if miss:
+            start = time.perf_counter()
+            computed = self._compute([X[i] for i in miss], None if masks is None else [masks[i] for i in miss])
+            with self.cache.lock:
+                self.cache.compute_time += time.perf_counter() - start
+            self.cache.put_many([keys[i] for i in miss], computed)
+        n_features = computed.shape[1] if computed is not None else len(found[keys[0]])
+        features = np.empty((len(X), n_features))
+        for (i, k) in enumerate(keys):
+            if k in found:
+                features[i] = found[k]
+        if computed is not None:
+            features[miss] = computed
+        return features
+
+    def fit_transform(self, X, *args, **kwargs):
+        """
+        Combine fit() and transform().
+        """
+        self.fit(X, *args, **kwargs)
+        return self.transform(X)
@@ -1,5 +1,154 @@
 import mahotas as mh
 import numpy as np
+from .parallel import effective_n_jobs, make_executor, chunk_slices
+from .instrumentation import traced
+
+def _haralick_chunk(X, distance, ignore_zeros):
+    """
+    Helper function: Haralick features of a chunk of images. All distances of an image are computed in one pass,
+    sharing its number of gray levels and the co-occurrence matrix buffer.
+    :param X: a list of single-channel ndarrays or an ndarray with shape (n_samples,H,W).
+    :param distance: an iterable of integers.
+    :param ignore_zeros: whether to ignore zero values (background) when constructing GLCM.
+    :return: ndarray with size (n_samples,52*len(distance))
+    """
+    features = np.empty((len(X), 52*len(distance)))
+    for (i,img) in enumerate(X):
+        fm1 = int(img.max()) + 1
+        cmat = np.empty((fm1, fm1), np.int32)
+        for (j,s) in enumerate(distance):
+            cmats = (mh.features.texture.cooccurence(img, d, cmat, symmetric=True, distance=s) for d in range(4))
+            features[i,52*j:52*(j+1)] = mh.features.texture.haralick_features(cmats, ignore_zeros=ignore_zeros).ravel()
+    return features
+
+# pixel offsets (y, x) of the four directions of adjacency, in the order used by mahotas
+_DIRECTIONS = ((0, 1), (1, 1), (1, 0), (1, -1))
+
+def _gray_dtype(top):
+    """
+    Helper function: smallest unsigned integer dtype holding the gray levels 0..top.
+    """
+    return np.uint8 if top < 256 else np.uint16 if top < 65536 else np.intp
+
+def _quantize(X, levels):
+    """
+    Helper function: quantize 8-bit images to `levels` gray levels, as uint8. Zero stays zero and every nonzero value
+    stays nonzero, so the background is still ignored with ignore_zeros=True. With 256 levels or more, the gray levels
+    are unchanged and stored in the smallest unsigned integer dtype holding them.
+    """
+    X = np.asarray(X)
+    top = int(X.max(initial=0))
+    if levels >= 256:
+        return X.astype(_gray_dtype(top), copy=False)
+    assert top < 256, "Images must be 8-bit to be quantized."
+    # 255 * (levels - 1) + 254 fits in uint16
+    return ((X.astype(np.uint16) * (levels - 1) + 254) // 255).astype(np.uint8)
+
+def _entropy(p):
+    """
+    Helper function: entropy (base 2) of each distribution along the last axis, ignoring empty bins.
+    """
+    return -(p * np.log2(np.where(p == 0, 1, p))).sum(axis=-1)
+
+def _glcm_features(q, dy, dx, ignore_zeros, L):
+    """
+    Helper function: the 13 Haralick features of the symmetric GLCMs of a stack of quantized images for one pixel
+    offset, computed for all images at once. The formulas follow mahotas.features.haralick_features.
+    :param q: ndarray with shape (n,H,W) of integer gray levels, all smaller than L.
+    :param dy, dx: pixel offset of the adjacent pixel.
+    :param ignore_zeros: whether to ignore zero values (background).
+    :param L: number of gray levels.
+    :return: ndarray with shape (n,13)
+    """
+    n, H, W = q.shape
+    # the gray levels are stored in a small dtype, the pixel pairs are indexed in intp
+    a = q[:, max(0, -dy):H - max(0, dy), max(0, -dx):W - max(0, dx)].reshape(n, -1).astype(np.intp)
+    b = q[:, max(0, dy):H - max(0, -dy), max(0, dx):W - max(0, -dx)].reshape(n, -1).astype(np.intp)
+    idx = np.broadcast_to(np.arange(n)[:, None], a.shape)
+    if ignore_zeros:
+        valid = (a != 0) & (b != 0)
+        idx, a, b = idx[valid], a[valid], b[valid]
+    else:
+        idx, a, b = idx.ravel(), a.ravel(), b.ravel()
+    # each pair is counted in both orders, so the normalization cancels the symmetric doubling
+    T = np.bincount(idx, minlength=n).astype(np.float64)
+    if (T == 0).any():
+        raise ValueError('haralick: the input is empty. Cannot compute features!\n' +
+                         'This can happen if you are using `ignore_zeros`')
+    C = np.bincount((idx * L + a) * L + b, minlength=n * L * L).reshape(n, L, L)
+    p = (C + C.transpose(0, 2, 1)) / (2 * T)[:, None, None]
+    px_plus_y = np.bincount(idx * 2 * L + a + b, minlength=n * 2 * L).reshape(n, 2 * L) / T[:, None]
+    px_minus_y = np.bincount(idx * L + np.abs(a - b), minlength=n * L).reshape(n, L) / T[:, None]
+
+    k = np.arange(L, dtype=np.float64)
+    k2 = k**2
+    tk = np.arange(2 * L, dtype=np.float64)
+    tk2 = tk**2
+    px = p.sum(1)
+    py = p.sum(2)
+    ux = px @ k
+    uy = py @ k
+    vx = px @ k2 - ux**2
+    vy = py @ k2 - uy**2
+    sx = np.sqrt(vx)
+    sy = np.sqrt(vy)
+
+    feats = np.empty((n, 13))
+    feats[:, 0] = np.einsum('nij,nij->n', p, p)
+    feats[:, 1] = px_minus_y @ k2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        corr = (1. / sx / sy) * (np.einsum('nij,i,j->n', p, k, k) - ux * uy)
+    feats[:, 2] = np.where((sx == 0) | (sy == 0), 1., corr)
+    feats[:, 3] = vx
+    feats[:, 4] = px_minus_y @ (1. / (k2 + 1))
+    feats[:, 5] = px_plus_y @ tk
+    feats[:, 7] = _entropy(px_plus_y)
+    feats[:, 6] = px_plus_y @ tk2 - feats[:, 5]**2
+    feats[:, 8] = _entropy(p.reshape(n, -1))
+    # mahotas sizes each GLCM after the largest gray level of its image, which sets the length of P(|x-y|)
+    m = q.reshape(n, -1).max(axis=1).astype(np.intp) + 1
+    in_range = k[None, :] < m[:, None]
+    mean = px_minus_y.sum(1) / m
+    feats[:, 9] = (((px_minus_y - mean[:, None])**2) * in_range).sum(1) / m
+    feats[:, 10] = _entropy(px_minus_y)
+    HX = _entropy(px)
+    HY = _entropy(py)
+    # log(px*py) summed over the GLCM separates into the marginals
+    log_px = np.log2(np.where(px == 0, 1, px))
+    log_py = np.log2(np.where(py == 0, 1, py))
+    HXY1 = -((py * log_px).sum(1) + (px * log_py).sum(1))
+    HXY2 = HX * py.sum(1) + HY * px.sum(1)
+    HXY = np.maximum(HX, HY)
+    feats[:, 11] = np.where(HXY == 0, feats[:, 8] - HXY1, (feats[:, 8] - HXY1) / np.where(HXY == 0, 1, HXY))
+    feats[:, 12] = np.sqrt(np.maximum(0, 1 - np.exp(-2. * (HXY2 - feats[:, 8]))))
+    return feats
+
+def _haralick_numpy_chunk(X, distance, ignore_zeros, levels):
+    """
+    Helper function: Haralick features of a chunk of images with the NumPy engine. GLCMs of a batch of images are
+    built with bincount over paired pixel values, and the features are computed for the whole batch at once.
+    :param X: a list of single-channel ndarrays or an ndarray with shape (n_samples,H,W).
+    :param distance: an iterable of integers.
+    :param ignore_zeros: whether to ignore zero values (background) when constructing GLCM.
+    :param levels: number of gray levels the images are quantized to.
+    :return: ndarray with size (n_samples,52*len(distance))
+    """
+    features = np.empty((len(X), 52*len(distance)))
+    if len(X) == 0:
+        return features
+    # quantization is monotonic, so the number of gray levels follows from the brightest pixel
+    top = int(X.max()) if isinstance(X, np.ndarray) else max(int(np.max(img)) for img in X)
+    L = int(_quantize(np.array([top]), levels)[0]) + 1
+    # bound the size of the GLCM stack to about 4M cells; images are quantized one batch at a time
+    batch = max(1, (1 << 22) // (L * L))
+    for start in range(0, len(X), batch):
+        s = slice(start, start + batch)
+        q = _quantize(X[s], levels)
+        for (j,dist) in enumerate(distance):
+            for (d,(dy,dx)) in enumerate(_DIRECTIONS):
+                col = 52*j + 13*d
+                features[s, col:col+13] = _glcm_features(q, dy*dist, dx*dist, ignore_zeros, L)
+    return features
 
 class haralick:
     """
@@ -54,17 +203,31 @@ class haralick:
     from the recurring spatial relationship between specific intensity values. It is a complementary value to InfoMeas1
     and is on a different scale.
     """
-    def __init__(self,distance,ignore_zeros=True):
+    def __init__(self,distance,ignore_zeros=True,n_jobs=1,backend="process",chunk_size=256,engine="mahotas",levels=256):
         """
         Constructor of Haralick feature extraction object.
         :param distance: the distance between a pair of pixels to be considered adjacent. It can be an iterable of any
         size, containing integers. For input image with size M*N, the integer needs to be an integer in the range of
         [1,min(M,N)-1].
         :param ignore_zeros: whether to ignore zero values (background) when constructing GLCM. Default to True.
+        :param n_jobs: number of workers extracting features. Default to 1 (serial), -1 uses all cores.
+        :param backend: 'process' or 'thread' pool. Default to 'process', since most of the work holds the GIL.
+        :param chunk_size: number of images handed to a worker at a time.
+        :param engine: 'mahotas' (default) or 'numpy'. The NumPy engine builds the GLCMs and computes the features for
+        a batch of images at once, and matches mahotas at 256 gray levels.
+        :param levels: number of gray levels 8-bit images are quantized to by the NumPy engine. Default to 256 (no
+        quantization); 32 or 64 levels are much faster. Zero pixels stay zero and nonzero pixels stay nonzero.
         """
+        assert engine in ("mahotas", "numpy"), "engine must be either 'mahotas' or 'numpy'."
         self.distance = distance
         self.ignore_zeros = ignore_zeros
+        self.n_jobs = n_jobs
+        self.backend = backend
+        self.chunk_size = chunk_size
+        self.engine = engine
+        self.levels = levels
 
+    @traced("haralick.fit")
     def fit(self,X):
         """
         Fit input images into Haralick feature extraction object.
@@ -73,18 +236,27 @@ class haralick:
         """
         return self
 
+    @traced("haralick.transform")
     def transform(self,X):
         """
         Transform input image into Haralick features for each angle-distance combination. With length of distance=s,
         4*13*s features will be extracted for each input image.
+        Chunks of images are processed in parallel when n_jobs is not 1.
         :param X: Input image. It needs to be a list of single-channel ndarrays.
         :return: ndarray with size (n_samples,n_Haralick_features)
         """
-        features = [None]*len(X)
-        for (i,img) in enumerate(X):
-            haralick = [mh.features.haralick(img, ignore_zeros=self.ignore_zeros, distance=s).flatten()
-                        for s in self.distance]
-            features[i] = np.hstack(haralick) # 1D array with size n_Haralick_features
-        features = np.vstack(features)
+        distance = list(self.distance)
+        if self.engine == "numpy":
+            func, args = _haralick_numpy_chunk, (distance, self.ignore_zeros, self.levels)
+        else:
+            func, args = _haralick_chunk, (distance, self.ignore_zeros)
+        if effective_n_jobs(self.n_jobs) == 1:
+            return func(X, *args)
+        features = np.empty((len(X), 52*len(distance)))
+        chunks = chunk_slices(len(X), self.chunk_size)
+        with make_executor(self.n_jobs, self.backend) as executor:
+            futures = [executor.submit(func, X[s], *args) for s in chunks]
+            for (s, future) in zip(chunks, futures):
+                features[s] = future.result()
         return features
 
@@ -1,5 +1,81 @@
+import contextlib
 import cv2
 import numpy as np
+from .parallel import effective_n_jobs, make_executor, chunk_slices
+from .instrumentation import traced
+
+# number of images processed at a time by the vectorized batch operations
+CHUNK_SIZE = 1024
+
+def _as_foreground(mask):
+    """
+    Helper function: convert binary masks to 0/255 uint8 masks, so they can be applied with bitwise operations.
+    """
+    fg = np.not_equal(mask, 0).view(np.uint8)
+    return np.multiply(fg, 255, dtype=np.uint8)
+
+def _construct_masks(for_mask, ksize_g, ksize_m, out=None):
+    """
+    Helper function: construct the binary masks of a chunk of images, as described in image_preprocessing.ROI.
+    :param for_mask: (a list of single-channel arrays or an ndarray with shape (N,H,W)) images used to construct masks.
+    :param ksize_g: (tuple of ints) kernel size for Gaussian blur.
+    :param ksize_m: (tuple of ints) kernel size for morphological transformation of the binary mask.
+    :param out: (a list or an ndarray with shape (N,H,W)) where the masks are written. If not specified, a new list
+    is returned.
+    :return: masks, a list or ndarray
+    """
+    if out is None:
+        out = [None]*len(for_mask)
+    kernel = np.ones(ksize_m, np.uint8)
+    # intermediate images are reused from one image to the next
+    blur = thr = opening = None
+    for (i,r) in enumerate(for_mask):
+        # Apply Gaussian filter and Otsu thresholding to for_mask images
+        blur = cv2.GaussianBlur(r, ksize_g, 0, dst=blur)
+        ret, thr = cv2.threshold(blur, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU, dst=thr)
+        # remove noise
+        opening = cv2.morphologyEx(thr, cv2.MORPH_OPEN, kernel, dst=opening, iterations=2)
+        # dilate and make final mask
+        if isinstance(out, np.ndarray):
+            cv2.dilate(opening, kernel, dst=out[i], iterations=3)
+        else:
+            out[i] = cv2.dilate(opening, kernel, iterations=3)
+    return out
+
+def _as_mask(mask):
+    """
+    Helper function: binary masks as uint8 arrays, the type expected by the mask arguments of OpenCV.
+    """
+    mask = np.asarray(mask)
+    return mask.view(np.uint8) if mask.dtype == bool else np.ascontiguousarray(mask, dtype=np.uint8)
+
+def _mean_std(src, fg):
+    """
+    Helper function: mean and standard deviation of each uint8 image in a contiguous stack within the foreground of
+    its 0/255 mask, computed the same way as cv2.meanStdDev(img, mask=mask).
+    """
+    n = len(src)
+    counts = np.count_nonzero(fg.reshape(n, -1), axis=1)
+    flat = np.bitwise_and(src, fg).reshape(n, -1)
+    sums = flat.sum(axis=1, dtype=np.int64)
+    # squares of uint8 values fit in uint16
+    sq = flat.astype(np.uint16)
+    np.multiply(sq, sq, out=sq)
+    sqsums = sq.sum(axis=1, dtype=np.int64)
+    # empty masks give a mean and STD of 0, like OpenCV
+    scale = 1. / np.maximum(counts, 1)
+    mean = sums * scale
+    std = np.sqrt(np.maximum(sqsums * scale - mean * mean, 0.))
+    return mean, std
+
+def _clip_bounds(mean, STD, offset):
+    """
+    Helper function: uint8 bounds of the range (mean - offset * STD, mean + offset * STD). Clipping uint8 images to
+    these bounds equals clipping them to the float range and truncating the result back to uint8.
+    """
+    lo = np.clip(np.floor(mean - offset * STD), 0, 255).astype(np.uint8)
+    hi = np.clip(np.floor(mean + offset * STD), 0, 255).astype(np.uint8)
+    return lo, hi
 
 class image_preprocessing:
     """
@@ -9,6 +85,9 @@ class image_preprocessing:
     which is our region of interest.Foreground:255, background: 0. The binary mask is superimposed on the green channel
     so that pixels in foreground maintains its original value, while those in background are reduced to 0.
     - image_normalize: Normalize the images to the range 0-255 with a specified option.
+    Each step also has a batched mode: when a stacked ndarray is given instead of a list (shape (N,H,W,3) for
+    split_channels, (N,H,W) afterwards), channels are taken as views, outputs are preallocated (N,H,W) uint8 arrays
+    and masking, clipping and image statistics are vectorized across the batch.
     """
     def __init__(self,split=True):
         """
@@ -18,14 +97,27 @@ class image_preprocessing:
         """
         self.split=split
 
+    @traced("image_preprocessing.split_channels", items=lambda out: len(out[0]))
     def split_channels(self,src):
         """
         Split the input RGB image into three channels. Return single channel images.
-        :param src: a list of multi-channel arrays
+        :param src: a list of multi-channel arrays, or an ndarray with shape (N,H,W,3) for batched mode.
         :return: A tuple of two lists: one containing single-channel arrays as the working images
         (green channel or grayscale), the other contains single-channel arrays to be used for mask generation
-        (red channel). Blue channel is discarded since its empty.
+        (red channel). Blue channel is discarded since its empty. In batched mode, two (N,H,W) arrays are returned
+        instead; the channels are views of src rather than copies.
         """
+        if isinstance(src, np.ndarray):
+            assert src.ndim == 4 and src.shape[3] == 3, "Batched input must have shape (N,H,W,3)."
+            self.for_mask = src[..., 2]
+            if self.split==True:
+                self.img = src[..., 1]
+            else:
+                # color conversion is per pixel, so the whole batch can be converted as one tall image
+                N, H, W, _ = src.shape
+                bgr = np.ascontiguousarray(src).reshape(N * H, W, 3)
+                self.img = cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY).reshape(N, H, W)
+            return (self.img, self.for_mask)
         b = [None]*len(src)
         g = [None]*len(src)
         r = [None]*len(src)
@@ -41,21 +133,31 @@ class image_preprocessing:
             self.img = gray
         return (self.img, self.for_mask)
 
-    def ROI(self,src=None,for_mask=None,ksize_g=(5, 5), ksize_m=(3, 3)):
+    @traced("image_preprocessing.ROI", items=lambda out: len(out[0]))
+    def ROI(self,src=None,for_mask=None,ksize_g=(5, 5), ksize_m=(3, 3), n_jobs=1, backend="thread", chunk_size=256,
+            executor=None):
         """
         Generate a binary mask from red channel and apply to green channel as region of interest (ROI).
         :param src: (a list of single-channel arrays) Source image to be superimposed with constructed mask.
+        An ndarray with shape (N,H,W) selects the batched mode.
         :param for_mask: (a list of single-channel arrays) Used to construct binary mask.
         Its length must be equal to that of source image list.
         :param ksize_g: (tuple of ints) kernel size for Gaussian blur. ksize width and height can be different,
         but both have to be positive and odd
         :param ksize_m: (tuple of ints) kernel size for morphological transformation of the binary mask.
+        :param n_jobs: (int) number of workers constructing the masks. Default to 1 (serial), -1 uses all cores.
+        :param backend: (str) 'thread' or 'process' pool. OpenCV releases the GIL, so threads are usually enough, and
+        in batched mode they write their masks straight into the shared output array.
+        :param chunk_size: (int) number of images handed to a worker at a time.
+        :param executor: an optional pool of workers (see parallel.make_executor) of the given backend, reused instead
+        of creating a pool of n_jobs workers for this call.
         :return:
             - mask: (a list of single-channel arrays) a binary mask where foreground (value 255) defines ROI.
             _ img_masked: (a list of single-channel arrays) masked source image where only pixel values within defined
             ROI are maintained.
+            In batched mode, both are returned as (N,H,W) uint8 arrays.
         """
-        if src:
+        if src is not None:
             self.img = src
         else:
             src=self.img
@@ -63,68 +165,230 @@ class image_preprocessing:
             for_mask=self.for_mask
         assert len(src)==len(for_mask), "Number of source images and number of for_mask images do not equal."
 
-        self.mask = [None]*len(for_mask)
-        self.img_masked = [None]*len(src)
-        for (i,(g,r)) in enumerate(zip(src,for_mask)):
-            # construct binary masks
-            # Apply Gaussian filter and Otsu thresholding to for_mask images
-            blur = cv2.GaussianBlur(r, ksize_g, 0)
-            ret, thr = cv2.threshold(blur, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-            # remove noise
-            kernel = np.ones(ksize_m, np.uint8)
-            opening = cv2.morphologyEx(thr, cv2.MORPH_OPEN, kernel, iterations=2)
-            # dilate and make final mask
-            mask = cv2.dilate(opening, kernel, iterations=3)
-            self.mask[i] = mask
-            # Filter source images with constructed masks
-            img_copy = g.copy()
-            img_copy[mask == 0] = 0
-            self.img_masked[i] = img_copy
+        batched = isinstance(src, np.ndarray)
+        self.mask = np.empty(np.shape(for_mask), np.uint8) if batched else [None]*len(for_mask)
+        chunks = chunk_slices(len(for_mask), chunk_size)
+        shared = batched and backend == "thread"
+        if executor is not None:
+            self._construct_masks_parallel(executor, for_mask, ksize_g, ksize_m, chunks, shared)
+        elif effective_n_jobs(n_jobs) == 1:
+            _construct_masks(for_mask, ksize_g, ksize_m, self.mask)
+        else:
+            with make_executor(n_jobs, backend) as executor:
+                self._construct_masks_parallel(executor, for_mask, ksize_g, ksize_m, chunks, shared)
+
+        if batched:
+            # masks only take the values 0 and 255, so a bitwise and keeps the foreground pixels
+            self.img_masked = np.bitwise_and(src, self.mask)
+        else:
+            self.img_masked = [None]*len(src)
+            for (i,(g,mask)) in enumerate(zip(src,self.mask)):
+                # Filter source images with constructed masks
+                img_copy = g.copy()
+                img_copy[mask == 0] = 0
+                self.img_masked[i] = img_copy
         return (self.mask,self.img_masked)
 
-    def image_normalize(self,option,src=None,mask=None,offset=2.5):
+    def _construct_masks_parallel(self, executor, for_mask, ksize_g, ksize_m, chunks, shared):
         """
-        Perform min-max normalization on input images with a specified option.
+        Helper function: construct the masks of the chunks on a pool of workers. Threads write into the shared output
+        array, otherwise chunks are gathered in order.
+        """
+        futures = [executor.submit(_construct_masks, for_mask[s], ksize_g, ksize_m,
+                                   self.mask[s] if shared else None) for s in chunks]
+        for (s, future) in zip(chunks, futures):
+            masks = future.result()
+            if not shared:
+                self.mask[s] = masks
+
+    @traced("image_preprocessing.image_normalize", items=len)
+    def image_normalize(self,option,src=None,mask=None,offset=2.5,out=None,inplace=False):
+        """
+        Perform min-max normalization on input images with a specified option. Source images are never modified
+        unless inplace is set.
         :param option: 'whole','ROI',or 'ROI_on_whole'.
             - 'whole': min-max normalization in range (0,255) is applied to the whole image.
-            - 'ROI': min-max normalization is only applied to the ROI.
+            - 'ROI': min-max normalization is only applied to the ROI. Pixels outside the ROI are set to 0.
             - 'ROI_on_whole': Clipping the whole image to the range (mean - offset * STD, mean + offset * STD), where
             mean and STD is calculated for ROI. Then perform min-max normalization.
         :param src: (a list of single-channel arrays) source images.
         If not specified, must call the split_channels or ROI function in class image_preprocessing first.
+        An ndarray with shape (N,H,W) selects the batched mode, which requires uint8 images and returns an (N,H,W)
+        uint8 array.
         :param mask: (a list of single-channel arrays) must be binary images. Number of masks must equal to that of src.
         No need to specify if 'whole' was chosen for option.
         Otherwise, if not specified, you must call the ROI function in class image_preprocessing first.
         :param offset: (int) parameter that only needs to be specified if option 'ROI_on_whole' is chosen.
+        :param out: (a list of uint8 arrays or an ndarray with shape (N,H,W)) optional preallocated buffers, with the
+        same shapes as src, where the normalized images are written.
+        :param inplace: (bool) whether to write the normalized images into src. Ignored if out is specified.
         :return: (a list of single-channel arrays) normalized images.
         """
         if src is None:
             src = self.img
-        self.normalized = [None] * len(src)
-        if option == 'whole':
-            for (i,img) in enumerate(src):
-                self.normalized[i]=cv2.normalize(img, 0, 255, norm_type=cv2.NORM_MINMAX)
-        elif option == 'ROI':
-            if mask is None:
-                mask = self.mask
+        if mask is None and option in ('ROI', 'ROI_on_whole'):
+            mask = self.mask
+        if option in ('ROI', 'ROI_on_whole'):
             assert len(src) == len(mask), "Number of source images and number of masks do not equal."
-            for (i,(g,m)) in enumerate(zip(src,mask)):
-                #assert len(np.unique(m)) == 2, "Mask is not binary"
-                self.normalized[i]=cv2.normalize(g, 0, 255, norm_type=cv2.NORM_MINMAX, mask=m)
-        elif option=='ROI_on_whole':
-            if mask is None:
-                roi = self.img_masked
-            else:
-                assert len(src) == len(mask), "Number of source images and number of masks do not equal."
-                roi = src.copy()
-                for (i,(g,m)) in enumerate(zip(roi,mask)):
-                    #assert len(np.unique(m)) == 2, "Mask is not binary."
-                    g[m == 0] = 0
-            for (i,(g,r)) in enumerate(zip(src,roi)):
+        if out is None and inplace:
+            out = src
+        if isinstance(src, np.ndarray):
+            assert src.dtype == np.uint8, "The batched mode of image_normalize requires uint8 images."
+            return self._image_normalize_batch(option, src, mask, offset, out)
+        self.normalized = [None] * len(src)
+        for (i,g) in enumerate(src):
+            dst = None if out is None else out[i]
+            if option == 'whole':
+                self.normalized[i] = cv2.normalize(g, dst, 0, 255, norm_type=cv2.NORM_MINMAX)
+            elif option == 'ROI':
+                m = _as_mask(mask[i])
+                dst = cv2.normalize(g, dst, 0, 255, norm_type=cv2.NORM_MINMAX, mask=m)
+                # background pixels of a preallocated buffer are not written by cv2.normalize
+                dst[m == 0] = 0
+                self.normalized[i] = dst
+            elif option=='ROI_on_whole':
                 # Calculate mean and STD of roi
-                mean, STD = cv2.meanStdDev(r)
+                mean, STD = cv2.meanStdDev(g, mask=_as_mask(mask[i]))
+                lo, hi = _clip_bounds(mean[0, 0], STD[0, 0], offset)
                 # Clip whole image
-                clipped = np.clip(g, mean - offset * STD, mean + offset * STD).astype(np.uint8)
+                clipped = np.clip(g, lo, hi, out=dst)
                 # Normalize to range
-                self.normalized[i] = cv2.normalize(clipped, 0, 255, norm_type=cv2.NORM_MINMAX)
+                self.normalized[i] = cv2.normalize(clipped, clipped, 0, 255, norm_type=cv2.NORM_MINMAX)
         return self.normalized
+
+    def _image_normalize_batch(self, option, src, mask, offset, out):
+        """
+        Batched mode of image_normalize. Statistics, clipping and masking are vectorized over contiguous chunks of
+        the batch, and each image is min-max normalized into a chunk buffer which is then copied to the output.
+        """
+        self.normalized = np.empty(src.shape, np.uint8) if out is None else out
+        for start in range(0, len(src), CHUNK_SIZE):
+            s = slice(start, start + CHUNK_SIZE)
+            g = np.ascontiguousarray(src[s])
+            # pixels outside the mask stay 0 with the 'ROI' option
+            buf = np.zeros(g.shape, np.uint8)
+            if option == 'whole':
+                for i in range(len(g)):
+                    cv2.normalize(g[i], buf[i], 0, 255, norm_type=cv2.NORM_MINMAX)
+            elif option == 'ROI':
+                m = _as_mask(mask[s])
+                for i in range(len(g)):
+                    cv2.normalize(g[i], buf[i], 0, 255, norm_type=cv2.NORM_MINMAX, mask=m[i])
+            elif option == 'ROI_on_whole':
+                mean, STD = _mean_std(g, _as_foreground(np.asarray(mask[s])))
+                lo, hi = _clip_bounds(mean, STD, offset)
+                np.clip(g, lo[:, None, None], hi[:, None, None], out=buf)
+                for i in range(len(g)):
+                    cv2.normalize(buf[i], buf[i], 0, 255, norm_type=cv2.NORM_MINMAX)
+            self.normalized[s] = buf
+        return self.normalized
+
+
+class preprocessing_pipeline:
+    """
+    Fused preprocessing pipeline: split channels -> construct mask -> mask image -> normalize, run on one chunk of
+    images at a time with the batched mode of image_preprocessing. Only the outputs requested by the caller are kept,
+    so at most one chunk of intermediate images is alive at any time. It can be used eagerly (transform) or as a
+    streaming stage whose chunks are fed straight into the feature extractors (stream), e.g.:
+
+        pipe = preprocessing_pipeline(outputs=('normalized',))
+        for out in pipe.stream(utils.iter_data('train')):
+            features.append(extractor.transform(out['normalized']))
+    """
+    OUTPUTS = ('img', 'for_mask', 'mask', 'img_masked', 'normalized')
+
+    def __init__(self, split=True, option='ROI_on_whole', offset=2.5, ksize_g=(5, 5), ksize_m=(3, 3),
+                 outputs=('normalized',), chunk_size=1024, n_jobs=1, backend="thread"):
+        """
+        Constructor of the preprocessing pipeline.
+        :param split (bool): whether to split the rgb image to three channels (see image_preprocessing).
+        :param option: normalization option, 'whole', 'ROI', 'ROI_on_whole' or None to skip normalization.
+        :param offset: (float) offset used by the 'ROI_on_whole' option.
+        :param ksize_g: (tuple of ints) kernel size for Gaussian blur when constructing masks.
+        :param ksize_m: (tuple of ints) kernel size for morphological transformation of the masks.
+        :param outputs: (tuple of str) outputs to return, among 'img', 'for_mask', 'mask', 'img_masked' and
+        'normalized'.
+        :param chunk_size: (int) number of images processed in one pass.
+        :param n_jobs: (int) number of workers constructing the masks of a chunk.
+        :param backend: (str) 'thread' or 'process' pool used to construct the masks.
+        """
+        assert option in ('whole', 'ROI', 'ROI_on_whole', None), "Unknown normalization option."
+        for name in outputs:
+            assert name in self.OUTPUTS, "Unknown output: " + str(name)
+        assert option is not None or 'normalized' not in outputs, "'normalized' output requires an option."
+        self.split = split
+        self.option = option
+        self.offset = offset
+        self.ksize_g = ksize_g
+        self.ksize_m = ksize_m
+        self.outputs = tuple(outputs)
+        self.chunk_size = chunk_size
+        self.n_jobs = n_jobs
+        self.backend = backend
+
+    def pool(self):
+        """
+        Pool of n_jobs workers constructing the masks, to be shared by all the chunks of a stream. When n_jobs is 1,
+        an empty context yielding None is returned instead.
+        """
+        if effective_n_jobs(self.n_jobs) == 1:
+            return contextlib.nullcontext()
+        return make_executor(self.n_jobs, self.backend)
+
+    def process_chunk(self, X, executor=None):
+        """
+        Run the fused pipeline on one chunk of images.
+        :param X: a list of multi-channel arrays or an ndarray with shape (n,H,W,3).
+        :param executor: an optional pool of workers constructing the masks (see pool()). If not given, a pool is
+        created for this chunk when n_jobs is not 1.
+        :return: dict mapping each requested output to an (n,H,W) uint8 array.
+        """
+        X = np.asarray(X) if not isinstance(X, np.ndarray) else X
+        prep = image_preprocessing(split=self.split)
+        prep.split_channels(X)
+        if self.option in ('ROI', 'ROI_on_whole') or 'mask' in self.outputs or 'img_masked' in self.outputs:
+            prep.ROI(ksize_g=self.ksize_g, ksize_m=self.ksize_m, n_jobs=self.n_jobs, backend=self.backend,
+                     chunk_size=max(len(X) // max(effective_n_jobs(self.n_jobs), 1), 1), executor=executor)
+        if self.option is not None and 'normalized' in self.outputs:
+            prep.image_normalize(self.option, offset=self.offset)
+        return {name: getattr(prep, name) for name in self.outputs}
+
+    def stream(self, X):
+        """
+        Lazily run the pipeline chunk by chunk.
+        :param X: a list of multi-channel arrays, an ndarray with shape (N,H,W,3), or an iterable of batches such as
+        the generator returned by utils.iter_data. Batches given as (images, labels) tuples keep their labels.
+        :return: generator of dicts mapping each requested output to an (n,H,W) uint8 array of the chunk, plus 'y'
+        when labels were given with the batches.
+        """
+        with self.pool() as executor:
+            if isinstance(X, (np.ndarray, list)):
+                for s in chunk_slices(len(X), self.chunk_size):
+                    yield self.process_chunk(X[s], executor)
+            else:
+                for batch in X:
+                    if isinstance(batch, tuple):
+                        out = self.process_chunk(batch[0], executor)
+                        out['y'] = batch[1]
+                    else:
+                        out = self.process_chunk(batch, executor)
+                    yield out
+
+    @traced("preprocessing_pipeline.transform")
+    def transform(self, X):
+        """
+        Run the pipeline on all images, writing each chunk into preallocated output arrays.
+        :param X: a list of multi-channel arrays or an ndarray with shape (N,H,W,3).
+        :return: dict mapping each requested output to an (N,H,W) uint8 array.
+        """
+        N = len(X)
+        results = {}
+        start = 0
+        for out in self.stream(X):
+            n = len(out[self.outputs[0]])
+            for name in self.outputs:
+                if name not in results:
+                    results[name] = np.empty((N,) + out[name].shape[1:], np.uint8)
+                results[name][start:start + n] = out[name]
+            start += n
+        return results
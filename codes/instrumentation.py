@@ -0,0 +1,230 @@
+import functools
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+# sinks receiving the span records. Instrumentation is enabled when there is at least one sink.
+# Spans are recorded in the calling process only, not in the workers of process pools.
+_sinks = []
+_local = threading.local()
+
+def enable(*sinks):
+    """
+    Enable instrumentation: every span of load_data, image_preprocessing and the extractors is sent to the sinks.
+    A sink is any object with an emit(record) method, e.g. MemoryCollector or JSONLinesSink.
+    """
+    _sinks.extend(sinks)
+
+def disable():
+    """
+    Disable instrumentation and detach all sinks.
+    """
+    del _sinks[:]
+
+def is_enabled():
+    return bool(_sinks)
+
+def peak_rss():
+    """
+    Peak resident memory of the process so far (its high-water mark) in bytes. ru_maxrss is in kB on Linux, in bytes
+    on macOS.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def current_rss():
+    """
+    Current resident memory of the process in bytes. Where /proc is not available, peak_rss() is returned instead.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return peak_rss()
+
+def _count(x):
+    """
+    Helper function: number of items of x, or None.
+    """
+    try:
+        return len(x)
+    except TypeError:
+        return None
+
+
+class _NullSpan:
+    """
+    Span returned when instrumentation is disabled: does nothing.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs):
+        return None
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span:
+    """
+    Timed section of the pipeline. On exit, a record with the name, start time, duration, number of items, memory
+    delta, parent span and attributes is sent to the sinks.
+    """
+    def __init__(self, name, n_items=None, attrs=None):
+        self.name = name
+        self.n_items = n_items
+        self.attrs = dict(attrs or {})
+
+    def set(self, n_items=None, **attrs):
+        """
+        Set the number of items processed (when it is only known inside the span) and other attributes.
+        """
+        if n_items is not None:
+            self.n_items = n_items
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        stack = getattr(_local, "stack", None)
+        if stack is None:
+            stack = _local.stack = []
+        self.parent = stack[-1].name if stack else None
+        stack.append(self)
+        self.rss_start = current_rss()
+        self.wall_start = time.time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.start
+        _local.stack.pop()
+        record = {"name": self.name,
+                  "parent": self.parent,
+                  "start": self.wall_start,
+                  "duration_s": duration,
+                  "n_items": self.n_items,
+                  "items_per_s": self.n_items / duration if self.n_items and duration > 0 else None,
+                  "rss_delta_bytes": current_rss() - self.rss_start,
+                  "thread": threading.current_thread().name,
+                  "error": None if exc_type is None else exc_type.__name__}
+        record.update(self.attrs)
+        for sink in list(_sinks):
+            sink.emit(record)
+        return False
+
+def span(name, n_items=None, **attrs):
+    """
+    Context manager timing a section of the pipeline, e.g.
+        with span("load_data") as s:
+            ...
+            s.set(n_items=n)
+    When instrumentation is disabled, a shared no-op span is returned.
+    """
+    if not _sinks:
+        return _NULL_SPAN
+    return Span(name, n_items, attrs)
+
+def traced(name, items=1):
+    """
+    Decorator timing every call of a function or method in a span called `name`. When instrumentation is disabled,
+    the function is called directly.
+    :param items: number of items processed by a call: either the index, in the positional arguments of the call
+    including self, of the argument whose length is counted (1 for the first argument of a method, 0 for the first
+    argument of a plain function), or a function computing it from the returned value.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _sinks:
+                return func(*args, **kwargs)
+            n_items = None
+            if isinstance(items, int) and len(args) > items:
+                n_items = _count(args[items])
+            with Span(name, n_items) as s:
+                result = func(*args, **kwargs)
+                if callable(items):
+                    s.set(n_items=items(result))
+            return result
+        return wrapper
+    return decorator
+
+
+class MemoryCollector:
+    """
+    Sink keeping the span records in memory.
+    """
+    def __init__(self):
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+    def clear(self):
+        self.records = []
+
+    def summary(self):
+        """
+        Summary of the collected spans, see summary().
+        """
+        return summary(self.records)
+
+    def report(self):
+        """
+        Text report of the collected spans, see report().
+        """
+        return report(self.records)
+
+
+class JSONLinesSink:
+    """
+    Sink appending each span record as a line of JSON to a file.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def emit(self, record):
+        line = json.dumps(record, default=str)
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(line + "\n")
+
+def read_jsonl(path):
+    """
+    Read the span records written by a JSONLinesSink.
+    """
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def summary(records):
+    """
+    Aggregate span records per stage (span name).
+    :return: dict mapping each stage, in order of first appearance, to its number of calls, total time, number of
+    items, throughput (items/s) and total memory delta.
+    """
+    stages = {}
+    for r in records:
+        s = stages.setdefault(r["name"], {"calls": 0, "total_s": 0., "n_items": 0, "rss_delta_bytes": 0})
+        s["calls"] += 1
+        s["total_s"] += r["duration_s"]
+        s["n_items"] += r["n_items"] or 0
+        s["rss_delta_bytes"] += r["rss_delta_bytes"]
+    for s in stages.values():
+        s["items_per_s"] = s["n_items"] / s["total_s"] if s["n_items"] and s["total_s"] > 0 else None
+    return stages
+
+def report(records):
+    """
+    Text table of the time and images/s of each stage.
+    """
+    lines = ["%-44s %6s %10s %10s %12s %10s" % ("stage", "calls", "time (s)", "items", "items/s", "mem (MB)")]
+    for (name, s) in summary(records).items():
+        lines.append("%-44s %6d %10.3f %10d %12s %10.1f"
+                     % (name, s["calls"], s["total_s"], s["n_items"],
+                        "%.1f" % s["items_per_s"] if s["items_per_s"] else "-", s["rss_delta_bytes"] / 2 ** 20))
+    return "\n".join(lines)
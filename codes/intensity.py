@@ -1,35 +1,102 @@
 import numpy as np
 import cv2
+from .parallel import chunk_slices
+from .instrumentation import traced
+
+def _stack(X):
+    """
+    Helper function: a list of images as an ndarray with shape (n_samples, H, W). An ndarray is used as it is.
+    """
+    return X if isinstance(X, np.ndarray) else np.stack(X, axis=0)
+
+def _check_binary(mask):
+    """
+    Helper function: assert that each mask of a stack takes exactly two values, without sorting its pixels.
+    """
+    lo = mask.min(axis=(1, 2), keepdims=True)
+    hi = mask.max(axis=(1, 2), keepdims=True)
+    assert (lo != hi).all() and ((mask == lo) | (mask == hi)).all(), "Mask is not binary."
+
+def _intensity_chunk(img, mask):
+    """
+    Helper function: intensity features of a stack of images, in one vectorized pass. The ROI sums, sums of squares and
+    coordinate-weighted sums are accumulated exactly in int64 for integer images (float64 otherwise).
+    :param img: ndarray with shape (n_samples, H, W).
+    :param mask: boolean ndarray with shape (n_samples, H, W), or None.
+    :return: ndarray with shape (n_samples, 4), or (n_samples, 5) with MassDisplacement if mask is given.
+    """
+    integer = np.issubdtype(img.dtype, np.integer)
+    acc = np.int64 if integer else np.float64
+    n, H, W = img.shape
+    if mask is None:
+        roi = img
+        count = np.full(n, H * W, dtype=acc)
+        lo, hi = img.min(axis=(1, 2)), img.max(axis=(1, 2))
+    else:
+        roi = np.where(mask, img, 0).astype(img.dtype, copy=False)
+        count = mask.sum(axis=(1, 2), dtype=acc)
+        assert (count > 0).all(), "Empty ROI."
+        info = np.iinfo(img.dtype) if integer else np.finfo(img.dtype)
+        lo = np.where(mask, img, info.max).min(axis=(1, 2))
+        hi = np.where(mask, img, info.min).max(axis=(1, 2))
+    S = roi.sum(axis=(1, 2), dtype=acc)
+    SQ = np.einsum("nij,nij->n", roi, roi, dtype=acc)
+    mean = S / count
+    if integer:
+        var = (count * SQ - S * S) / (count * count)
+    else:
+        var = np.maximum(SQ / count - mean * mean, 0.)
+    features = [mean, np.sqrt(var), lo, hi]
+    if mask is not None:
+        rows = np.arange(H, dtype=acc)
+        cols = np.arange(W, dtype=acc)
+        # binary moments of the non-zero pixels of the ROI, and grayscale moments
+        nonzero = roi != 0
+        b00 = nonzero.sum(axis=(1, 2), dtype=np.int64)
+        b10 = nonzero.sum(axis=1, dtype=np.int64) @ cols.astype(np.int64)
+        b01 = nonzero.sum(axis=2, dtype=np.int64) @ rows.astype(np.int64)
+        g10 = roi.sum(axis=1, dtype=acc) @ cols
+        g01 = roi.sum(axis=2, dtype=acc) @ rows
+        with np.errstate(divide="ignore", invalid="ignore"):
+            # centroids are truncated to integers, as in binary_centroid() and gray_centroid()
+            dx = np.trunc(b10 / b00) - np.trunc(g10 / S)
+            dy = np.trunc(b01 / b00) - np.trunc(g01 / S)
+        features.append((dx ** 2 + dy ** 2) ** 0.5)
+    return np.stack(features, axis=1).astype(np.float64)
 
 class IntensityMeasure:
     """
     Extract intensity features from input images. An optional mask can be applied to define ROI, where intensity
-    measurements are made exclusively.
+    measurements are made exclusively. The images (and masks) are processed as stacks of chunk_size images, computing
+    all features in one vectorized pass without per-image copies.
     """
-    def __init__(self,mask=None):
+    def __init__(self,mask=None,check_mask=True,chunk_size=1024):
         """
         Class constructor method for intensity measurements.
-        :param mask: an optional mask. Must be a list of single-channel array with binary values. If not specified,
-        no mask will be applied.
+        :param mask: an optional mask. Must be a list of single-channel array with binary values, or an ndarray with
+        shape (n_samples, H, W). If not specified, no mask will be applied.
+        :param check_mask: (bool) assert that each mask is binary. Default to True.
+        :param chunk_size: (int) number of images processed at a time. Default to 1024.
         """
-        if mask:
-            for (i,m) in enumerate(mask):
-                assert len(np.unique(m)) == 2, "Mask is not binary."
+        if mask is not None and len(mask) == 0:
+            mask = None
+        if mask is not None and check_mask:
+            for s in chunk_slices(len(mask), chunk_size):
+                _check_binary(_stack(mask[s]))
         self.mask=mask
+        self.check_mask=check_mask
+        self.chunk_size=chunk_size
 
+    @traced("IntensityMeasure.fit")
     def fit(self,X):
         """
-        If mask is specified, apply mask to the input images X. Number of masks must equal number of input images.
-        :param X: a list of single-channel arrays.
+        Check the input images X. Number of masks must equal number of input images. The features are computed from
+        the images given to transform(), so nothing is stored.
+        :param X: a list of single-channel arrays, or an ndarray with shape (n_samples, H, W).
         :return: object, instance itself
         """
-        if self.mask:
+        if self.mask is not None:
             assert len(X) == len(self.mask), "Number of source images and number of masks do not equal."
-            self.roi = [None]*len(X)
-            for (i,(img,mask)) in enumerate(zip(X,self.mask)):
-                self.roi[i]=img[mask != 0]
-        else:
-            self.roi = X
         return self
 
     def binary_centroid(self,img):
@@ -54,7 +121,8 @@ class IntensityMeasure:
         Y_gy = int(M_gy["m01"] / M_gy["m00"])
         return (X_gy,Y_gy)
 
-    def transform(self,X):
+    @traced("IntensityMeasure.transform")
+    def transform(self,X,mask=None):
         """
         Measures several intensity features:
         @ MeanIntensity: the average pixel intensity
@@ -62,23 +130,25 @@ class IntensityMeasure:
         @ MinIntensity: the minimum of intensity
         @ MaxIntensity: the maximum of intensity
         @ MassDisplacement: difference between the centroids of ROI defined objects in grayscale representation and
-        that in binary representation. # Only applicable when self.mask is specified.
-        :param X: a list of single-channel arrays.
+        that in binary representation. # Only applicable when a mask is specified.
+        :param X: a list of single-channel arrays, or an ndarray with shape (n_samples, H, W).
+        :param mask: masks of X, overriding self.mask. Checked if check_mask is True.
         :return: ndarray with shape (n_samples, n_intensity_features)
         """
-        MeanIntensity = list(map(np.mean,self.roi))
-        StdIntensity = list(map(np.std,self.roi))
-        MinIntensity = list(map(np.min,self.roi))
-        MaxIntensity = list(map(np.max,self.roi))
-        if self.mask:
-            MassDisplacement = [None]*len(X)
-            for (i,(img,mask)) in enumerate(zip(X,self.mask)):
-                img_ = img.copy()
-                img_[mask==0]=0
-                X_bi,Y_bi = self.binary_centroid(img_)
-                X_gy,Y_gy = self.gray_centroid(img_)
-                MassDisplacement[i] = ((X_bi - X_gy) ** 2 + (Y_bi - Y_gy) ** 2) ** 0.5
-            intensity_features = np.vstack((MeanIntensity,StdIntensity,MinIntensity,MaxIntensity,MassDisplacement)).T
-        else:
-            intensity_features = np.vstack((MeanIntensity,StdIntensity,MinIntensity,MaxIntensity)).T
+        if mask is None:
+            mask = self.mask
+        elif self.check_mask:
+            for s in chunk_slices(len(mask), self.chunk_size):
+                _check_binary(_stack(mask[s]))
+        if mask is not None:
+            assert len(X) == len(mask), "Number of source images and number of masks do not equal."
+        intensity_features = np.empty((len(X), 4 if mask is None else 5))
+        for s in chunk_slices(len(X), self.chunk_size):
+            intensity_features[s] = _intensity_chunk(_stack(X[s]), None if mask is None else _stack(mask[s]) != 0)
         return intensity_features
+
+    def fit_transform(self,X,mask=None):
+        """
+        Combine fit() and transform().
+        """
+        return self.fit(X).transform(X,mask)
@@ -1,22 +1,69 @@
-# install PyCall from Julia's end
-import julia
-julia.install()
-
-from julia import Main
 import os
 import numpy as np
+import pywt
+from .parallel import chunk_slices, bounded_starmap
+from .instrumentation import traced, current_rss, peak_rss
 
-# set current directory as working directory
+# directory of the Julia environment (Project.toml, Manifest.toml)
 filedir = os.path.dirname(os.path.realpath(__file__))
-os.chdir(filedir)
-# activate current environment
-Main.eval("""
-using Pkg;
-Pkg.activate(".");
-Pkg.instantiate()
-""")
-Main.using("Wavelets")
-Main.using("WaveletsExt")
+
+# Julia Main module, initialized on first use, see julia_main()
+_Main = None
+
+def julia_main():
+    """
+    Return the Julia Main module, set up for LDB. On the first call in a process, the Julia runtime is started (PyCall
+    is only installed if it cannot be loaded), the environment of this directory is activated and instantiated, and
+    Wavelets/WaveletsExt and the wrapper functions are loaded. Later calls return the cached module.
+    """
+    global _Main
+    if _Main is None:
+        import julia
+        try:
+            from julia import Main
+        except Exception:
+            # install PyCall from Julia's end
+            julia.install()
+            from julia import Main
+        # activate the environment of this directory, without changing the working directory
+        Main.ldb_project_dir = filedir
+        Main.eval("""
+        using Pkg;
+        Pkg.activate(ldb_project_dir);
+        Pkg.instantiate()
+        """)
+        Main.using("Wavelets")
+        Main.using("WaveletsExt")
+        # wrapper functions taking the signals as a PyObject, so that PyCall does not convert (copy) them: the
+        # column-major NumPy buffer is wrapped as a Julia Array sharing its memory. The returned Julia arrays are
+        # seen from Python as NumPy arrays sharing their memory as well.
+        Main.eval("""
+            using PyCall
+            function ldb_array(o::PyObject)
+                A = PyArray(o)
+                return unsafe_wrap(Array, pointer(A), size(A))
+            end
+            ldb_fit = pyfunction((ldb, X, y) -> (fit!(ldb, ldb_array(X), y); nothing), PyAny, PyObject, PyAny)
+            ldb_transform = pyfunction((ldb, X) -> transform(ldb, ldb_array(X)), PyAny, PyObject)
+            ldb_fit_transform = pyfunction((ldb, X, y) -> fit_transform(ldb, ldb_array(X), y), PyAny, PyObject, PyAny)
+            ldb_inverse_transform = pyfunction((ldb, X) -> inverse_transform(ldb, ldb_array(X)), PyAny, PyObject)
+            ldb_change_nfeatures = pyfunction((ldb, X, n) -> change_nfeatures(ldb, ldb_array(X), n), PyAny, PyObject, Int)
+        """)
+        _Main = Main
+    return _Main
+
+def _signal_matrix(X, dtype):
+    """
+    Helper function: copy the images X into one C-ordered buffer of shape
+    (n_samples, n_pixels), each row holding a flattened image. An ndarray X
+    that is already contiguous and of dtype is used as it is.
+    """
+    if isinstance(X, np.ndarray):
+        return np.ascontiguousarray(X.reshape(len(X), -1), dtype=dtype)
+    buf = np.empty((len(X), np.size(X[0])), dtype=dtype)
+    for (i, img) in enumerate(X):
+        buf[i] = np.ravel(img)
+    return buf
 
 class LDB_FeatureExtractor:
     """
@@ -41,13 +88,25 @@ class LDB_FeatureExtractor:
     - tree => Compute best WPD tree based on DM
     - DP => Computed discriminant power
     - order => Ordering of DP by descending order
+    - memory_ => Memory of the last call, in bytes: size of the signal buffer
+        passed to Julia, resident memory of the process before and after the
+        call, and increase of the process peak resident memory (high-water
+        mark) over the call, which includes the transient allocations of
+        Julia. When the call does not exceed an earlier peak of the process,
+        the increase is 0 and peak_rss_bytes, the peak of the call, is None
+
+    The images are copied once into a single buffer of dtype, whose transpose
+    is the column-major (n_pixels, n_samples) matrix of signals. Julia reads
+    this buffer in place, and the computed features are returned as views of
+    the Julia arrays.
     """
-    def __init__(self, wt=Main.wavelet(Main.WT.haar), max_dec_level=Main.nothing,
-                 dm=Main.AsymmetricRelativeEntropy(), en=Main.TimeFrequency(),
-                 dp=Main.BasisDiscriminantMeasure(), top_k=Main.nothing, 
-                 n_features=Main.nothing):
+    def __init__(self, wt=None, max_dec_level=None, dm=None, en=None, dp=None,
+                 top_k=None, n_features=None, dtype=np.float64):
         """
-        Initialize LDB object. 
+        Initialize LDB object. The Julia runtime is started on the first LDB
+        object created in a process (see julia_main()), and reused afterwards.
+        Arguments left to None take the default values below. The Julia
+        objects below are accessed through Main = julia_main().
         
         Arguments:
         - wt => Default is Main.wavelet(Main.WT.haar). Other acceptable wavelets
@@ -75,46 +134,76 @@ class LDB_FeatureExtractor:
             are used.
         - n_features => Number of features to be returned in output. Default of 
             Main.nothing means all features are returned.
+        - dtype => Floating point type of the signals passed to Julia. Default
+            is np.float64, np.float32 halves the memory of the buffer.
         """
-        self.wt = wt
-        self.max_dec_level = max_dec_level
-        self.dm = dm
-        self.en = en
-        self.dp = dp
-        self.top_k = top_k
-        self.n_features = n_features
+        Main = julia_main()
+        self.wt = Main.wavelet(Main.WT.haar) if wt is None else wt
+        self.max_dec_level = Main.nothing if max_dec_level is None else max_dec_level
+        self.dm = Main.AsymmetricRelativeEntropy() if dm is None else dm
+        self.en = Main.TimeFrequency() if en is None else en
+        self.dp = Main.BasisDiscriminantMeasure() if dp is None else dp
+        self.top_k = Main.nothing if top_k is None else top_k
+        self.n_features = Main.nothing if n_features is None else n_features
+        self.dtype = dtype
+        self.memory_ = {}
         self.ldb = Main.LocalDiscriminantBasis(wt=self.wt, max_dec_level=self.max_dec_level,
                                                dm=self.dm, en=self.en, dp=self.dp,
                                                top_k=self.top_k, n_features=self.n_features)
 
+    def _signals(self, X):
+        """
+        Helper function: copy the images X into one C-ordered buffer of shape
+        (n_samples, n_pixels), see _signal_matrix(). Its transpose is the
+        column-major matrix of signals read by Julia.
+        """
+        self.shape = np.shape(X[0])
+        return _signal_matrix(X, self.dtype)
+
+    def _save_attributes(self):
+        """
+        Helper function: save the fitted attributes of the Julia LDB object,
+        as arrays sharing the memory of the Julia arrays where possible.
+        """
+        self.n = self.ldb.n
+        self.Gamma = np.asarray(self.ldb.Γ)
+        self.DM = np.asarray(self.ldb.DM)
+        self.cost = np.asarray(self.ldb.cost)
+        self.tree = np.asarray(self.ldb.tree)
+        self.DP = np.asarray(self.ldb.DP)
+        self.order = np.asarray(self.ldb.order) - 1 # python follows zero indexing
+
+    def _report_memory(self, buf, rss_before, peak_before):
+        """
+        Helper function: record in self.memory_ the size of the signal buffer,
+        the resident memory of the process before and after the call, and the
+        increase of its peak resident memory.
+        """
+        rss_after = current_rss()
+        peak_after = peak_rss()
+        self.memory_ = {"buffer_bytes": buf.nbytes,
+                        "rss_before_bytes": rss_before,
+                        "rss_after_bytes": rss_after,
+                        "rss_delta_bytes": rss_after - rss_before,
+                        "peak_rss_bytes": peak_after if peak_after > peak_before else None,
+                        "peak_increase_bytes": peak_after - peak_before}
+
+    @traced("LDB_FeatureExtractor.fit")
     def fit(self, X, y):
         """
         Fits the Local Discriminant Basis feature selection algorithm onto the
         input images X with labels y.
         """
+        rss_before, peak_before = current_rss(), peak_rss()
         # restructure data
-        n = len(X)
-        Xt = np.stack(X, axis=2)
-        Xt = Xt.reshape(-1,n)
-        Xt = Xt.astype("float")
-        # wrapper function for fit!
-        Main.eval("""
-            function fit(ldb, X, y)
-                fit!(ldb, X, y)
-            end
-        """)
+        buf = self._signals(X)
         # fit LDB
-        Main.fit(self.ldb, Xt, y)
-        # save attributes
-        self.n = self.ldb.n
-        self.Gamma = np.array(self.ldb.Γ)
-        self.DM = np.array(self.ldb.DM)
-        self.cost = np.array(self.ldb.cost)
-        self.tree = np.array(self.ldb.tree)
-        self.DP = np.array(self.ldb.DP)
-        self.order = np.array(self.ldb.order) - 1 # python follows zero indexing
+        julia_main().ldb_fit(self.ldb, buf.T, y)
+        self._save_attributes()
+        self._report_memory(buf, rss_before, peak_before)
         return None
 
+    @traced("LDB_FeatureExtractor.transform")
     def transform(self, X, y=None):
         """
         Extract the LDB features on signals X.
@@ -122,38 +211,30 @@ class LDB_FeatureExtractor:
         Input y is not used, but is included as a parameter by convention and is
         completely optional.
         """
+        rss_before, peak_before = current_rss(), peak_rss()
         # restructure data
-        n = len(X)
-        Xt = np.stack(X, axis=2)
-        Xt = Xt.reshape(-1,n)
-        Xt = Xt.astype("float")
+        buf = self._signals(X)
         # transform data based on LDB
-        Xf = Main.transform(self.ldb, Xt)
-        # transpose results to follow sklearn convention
-        Xf = Xf.T
+        Xf = julia_main().ldb_transform(self.ldb, buf.T)
+        # transpose results to follow sklearn convention (a view)
+        Xf = np.asarray(Xf).T
+        self._report_memory(buf, rss_before, peak_before)
         return Xf
 
+    @traced("LDB_FeatureExtractor.fit_transform")
     def fit_transform(self, X, y):
         """
         Fit and transform the images X with labels y using Local Discriminant
         Basis.
         """
+        rss_before, peak_before = current_rss(), peak_rss()
         # restructure data
-        n = len(X)
-        Xt = np.stack(X, axis=2)
-        Xt = Xt.reshape(-1,n)
-        Xt = Xt.astype("float")
+        buf = self._signals(X)
         # fit and transform the data
-        Xf = Main.fit_transform(self.ldb, Xt, y)
-        Xf = Xf.T
-        # save attributes
-        self.n = self.ldb.n
-        self.Gamma = np.array(self.ldb.Γ)
-        self.DM = np.array(self.ldb.DM)
-        self.cost = np.array(self.ldb.cost)
-        self.tree = np.array(self.ldb.tree)
-        self.DP = np.array(self.ldb.DP)
-        self.order = np.array(self.ldb.order) - 1 # python follows zero indexing
+        Xf = julia_main().ldb_fit_transform(self.ldb, buf.T, y)
+        Xf = np.asarray(Xf).T
+        self._save_attributes()
+        self._report_memory(buf, rss_before, peak_before)
         return Xf
 
     def inverse_transform(self, X, y=None):
@@ -164,18 +245,18 @@ class LDB_FeatureExtractor:
         Input y is not used, but is included as a parameter by convention and is
         completely optional.
         """
-        # restructure data
+        # restructure data: the transpose of a C-ordered feature matrix is
+        # column-major, as read by Julia
         N = X.shape[0]
-        x = X.T
+        x = np.ascontiguousarray(X, dtype=self.dtype).T
         # inverse transform the data
-        Xi = Main.inverse_transform(self.ldb, x)
-        # restructure data
-        Xi = Xi.T
-        Xi = Xi.reshape((64, 64, N))
-        # return as list of images
+        Xi = julia_main().ldb_inverse_transform(self.ldb, x)
+        # restructure data: column i of Xi is the flattened image i
+        Xi = np.asarray(Xi).T.reshape((N,) + tuple(self.shape))
+        # return as list of images (views)
         Xm = [None]*N
         for i in range(N):
-            Xm[i] = Xi[:,:,i]
+            Xm[i] = Xi[i]
         return Xm
 
     def change_nfeatures(self, X, n_features):
@@ -188,10 +269,439 @@ class LDB_FeatureExtractor:
         be less accurate and effective.
         """
         self.n_features = n_features
-        # transpose data to fit Julia convention
-        Xt = X.T
+        # transpose data to fit Julia convention (column-major)
+        Xt = np.ascontiguousarray(X, dtype=self.dtype).T
         # change number of features
-        Xt = Main.change_nfeatures(self.ldb, Xt, n_features)
-        # transpose data to fit Python convention
-        Xt = Xt.T
-        return Xt
\ No newline at end of file
+        Xt = julia_main().ldb_change_nfeatures(self.ldb, Xt, n_features)
+        # transpose data to fit Python convention (a view)
+        Xt = np.asarray(Xt).T
+        return Xt
+
+# options of NumpyLDB_FeatureExtractor, named after the corresponding WaveletsExt.jl types
+DISCRIMINANT_MEASURES = ("AsymmetricRelativeEntropy", "SymmetricRelativeEntropy", "LpEntropy", "HellingerDistance")
+ENERGY_MAPS = ("TimeFrequency", "ProbabilityDensity")
+DISCRIMINANT_POWERS = ("BasisDiscriminantMeasure", "FishersClassSeparability", "RobustFishersClassSeparability")
+
+def _wpd(X, wt, L):
+    """
+    Helper function: full wavelet packet decomposition of the signals X with
+    shape (n_samples, n), down to level L with periodic boundaries. Returns
+    an array of shape (n_samples, L+1, n) whose level l holds the
+    coefficients of the 2^l nodes of the level in natural order, node k
+    covering positions [k*n/2^l, (k+1)*n/2^l), approximation half first.
+    """
+    b, n = X.shape
+    W = np.empty((b, L + 1, n), dtype=X.dtype)
+    W[:, 0] = X
+    for l in range(L):
+        a, d = pywt.dwt(W[:, l].reshape(b, 2 ** l, n >> l), wt, mode="periodization", axis=-1)
+        W[:, l + 1] = np.stack((a, d), axis=2).reshape(b, n)
+    return W
+
+def _relative_entropy(P, Q):
+    """
+    Helper function: elementwise P*log(P/Q), set to 0 where P or Q is 0.
+    """
+    valid = (P > 0) & (Q > 0)
+    D = np.zeros(np.shape(P))
+    np.divide(P, Q, out=D, where=valid)
+    np.log(D, out=D, where=valid)
+    return D * P
+
+def _discriminant_measure(P, Q, dm, p=2):
+    """
+    Helper function: elementwise discriminant measure dm between the energy
+    maps P and Q of two classes.
+    """
+    if dm == "AsymmetricRelativeEntropy":
+        return _relative_entropy(P, Q)
+    elif dm == "SymmetricRelativeEntropy":
+        return _relative_entropy(P, Q) + _relative_entropy(Q, P)
+    elif dm == "LpEntropy":
+        return np.abs(P - Q) ** p
+    else:
+        return (np.sqrt(P) - np.sqrt(Q)) ** 2
+
+def _ash(counts, m):
+    """
+    Helper function: average shifted histogram (ASH) densities from fine
+    histogram counts along the last axis. Averaging m histograms shifted by
+    one fine bin amounts to weighting the neighbouring fine bins by the
+    triangular kernel 1-|i|/m. Each density is normalized to sum to 1.
+    """
+    dens = np.zeros(counts.shape)
+    n_bins = counts.shape[-1]
+    for i in range(1 - m, m):
+        w = 1. - abs(i) / m
+        if i >= 0:
+            dens[..., i:] += w * counts[..., :n_bins - i]
+        else:
+            dens[..., :i] += w * counts[..., -i:]
+    total = dens.sum(axis=-1, keepdims=True)
+    return np.divide(dens, total, out=dens, where=total > 0)
+
+def _node_cost(DM, L, top_k=None):
+    """
+    Helper function: cost of each node of the WPD tree (in breadth-first
+    order, 2^(L+1)-1 nodes), i.e. the sum of the top_k largest discriminant
+    measures of its coefficients (all of them if top_k is None).
+    """
+    n = DM.shape[0]
+    cost = np.empty(2 ** (L + 1) - 1)
+    for l in range(L + 1):
+        nodes = np.sort(DM[:, l].reshape(2 ** l, n >> l), axis=1)[:, ::-1]
+        if top_k is not None:
+            nodes = nodes[:, :top_k]
+        cost[2 ** l - 1:2 ** (l + 1) - 1] = nodes.sum(axis=1)
+    return cost
+
+def _best_tree(cost, L):
+    """
+    Helper function: best basis tree maximizing the node costs. A node is
+    split (True) when the best cost of its children is larger than its own
+    cost. Returns a boolean array over the 2^L-1 internal nodes, breadth-first.
+    """
+    best = cost.copy()
+    tree = np.zeros(2 ** L - 1, dtype=bool)
+    for l in range(L - 1, -1, -1):
+        idx = np.arange(2 ** l - 1, 2 ** (l + 1) - 1)
+        children = best[2 * idx + 1] + best[2 * idx + 2]
+        tree[idx] = best[idx] < children
+        best[idx] = np.maximum(best[idx], children)
+    # nodes below a node that is not split are not part of the tree
+    for l in range(1, L):
+        idx = np.arange(2 ** l - 1, 2 ** (l + 1) - 1)
+        tree[idx] &= tree[(idx - 1) // 2]
+    return tree
+
+def _basis_levels(tree, L, n):
+    """
+    Helper function: level of the best basis node covering each coefficient
+    position.
+    """
+    levels = np.zeros(n, dtype=np.intp)
+    for l in range(L):
+        split = tree[2 ** l - 1:2 ** (l + 1) - 1]
+        levels[np.repeat(split, n >> l)] = l + 1
+    return levels
+
+def _basis_coefs(X, wt, levels):
+    """
+    Helper function: best basis coefficients of the signals X, with shape
+    (n_samples, n).
+    """
+    W = _wpd(X, wt, int(levels.max(initial=0)))
+    return W[:, levels, np.arange(X.shape[1])]
+
+def _ldb_energy(X, y, wt, L, n_classes):
+    """
+    Helper function: per-class sums of the squared WPD coefficients of a
+    batch, with shape (n_classes, L+1, n), and of the squared signal norms.
+    """
+    W = _wpd(X, wt, L)
+    energy = np.zeros((n_classes,) + W.shape[1:])
+    norms = np.zeros(n_classes)
+    for c in np.unique(y):
+        idx = y == c
+        energy[c] = np.einsum("ilj,ilj->lj", W[idx], W[idx])
+        norms[c] = np.einsum("ij,ij->", X[idx], X[idx])
+    return energy, norms
+
+def _ldb_range(X, wt, L):
+    """
+    Helper function: minimum and maximum of each WPD coefficient over a batch.
+    """
+    W = _wpd(X, wt, L)
+    return W.min(axis=0), W.max(axis=0)
+
+def _ldb_histogram(X, y, wt, L, n_classes, lo, hi, n_bins):
+    """
+    Helper function: per-class histograms of each WPD coefficient over a
+    batch, on n_bins bins between lo and hi. Returns int32 counts with shape
+    (n_classes, L+1, n, n_bins).
+    """
+    W = _wpd(X, wt, L)
+    width = np.where(hi > lo, hi - lo, 1.)
+    bins = ((W - lo) / width * n_bins).astype(np.intp)
+    np.clip(bins, 0, n_bins - 1, out=bins)
+    n_cells = lo.size
+    bins += np.arange(n_cells).reshape(lo.shape) * n_bins
+    counts = np.zeros((n_classes,) + lo.shape + (n_bins,), dtype=np.int32)
+    for c in np.unique(y):
+        counts[c] = np.bincount(bins[y == c].ravel(), minlength=n_cells * n_bins).reshape(counts.shape[1:])
+    return counts
+
+def _ldb_features(X, wt, levels, features):
+    """
+    Helper function: the selected best basis coefficients of a batch.
+    """
+    return _basis_coefs(X, wt, levels)[:, features]
+
+def _ldb_inverse(F, wt, tree, L, features, n):
+    """
+    Helper function: reconstruct the signals of a batch of features F. The
+    unselected coefficients are set to 0, then the split nodes are rebuilt
+    from their children, from the deepest level up.
+    """
+    coefs = np.zeros((len(F), n))
+    coefs[:, features] = F
+    for l in range(L - 1, -1, -1):
+        split = np.flatnonzero(tree[2 ** l - 1:2 ** (l + 1) - 1])
+        if len(split) == 0:
+            continue
+        m = n >> l
+        nodes = coefs.reshape(len(F), 2 ** l, m)
+        sub = nodes[:, split]
+        nodes[:, split] = pywt.idwt(sub[..., :m // 2], sub[..., m // 2:], wt, mode="periodization", axis=-1)
+    return coefs
+
+
+class NumpyLDB_FeatureExtractor:
+    """
+    Local Discriminant Basis feature extraction implemented with NumPy and
+    PyWavelets, which does not need Julia. It follows the pipeline of
+    LocalDiscriminantBasis in WaveletsExt.jl on the same input, i.e. images
+    flattened into 1D signals:
+
+    1. Wavelet packet decomposition (WPD) of the signals, with periodic
+    boundaries.
+    2. Energy map of each class: normalized time-frequency energies, or
+    probability densities of the coefficients estimated by averaged
+    shifted histograms.
+    3. Discriminant measure of each coefficient, summed over all pairs of
+    classes.
+    4. Best basis search: a node is split when its children are more
+    discriminant, as measured by the sum of the top_k largest discriminant
+    measures of their coefficients.
+    5. Discriminant power of each best basis coefficient, ordering of the
+    coefficients by decreasing power and selection of the first n_features.
+
+    The signals are processed in batches of batch_size, vectorized over the
+    batch axis, and the batches can be distributed over n_jobs workers.
+
+    This class is not a drop-in replacement for LDB_FeatureExtractor: its
+    outputs have not been checked against the Julia backend. Features may
+    differ, in particular for non-haar wavelets (the filter conventions of
+    PyWavelets and Wavelets.jl may differ) and in their signs, so features
+    and models of one backend should not be mixed with the other.
+    tests/test_numpy_ldb.py compares both backends on a fixed test set once
+    the Julia reference is generated with tests/make_ldb_reference.py.
+
+    Attributes (named as in LDB_FeatureExtractor):
+    - n => Length of signal
+    - classes => Class labels
+    - Gamma => Computed energy map, with shape (n, L+1, n_classes), or
+        (n, L+1, n_bins, n_classes) for ProbabilityDensity
+    - DM => Computed discriminant measure, with shape (n, L+1)
+    - cost => Computed WPD tree cost of each node (breadth-first)
+    - tree => Best WPD tree: True for each split internal node (breadth-first)
+    - DP => Computed discriminant power
+    - order => Ordering of DP by descending order
+    """
+    def __init__(self, wt="haar", max_dec_level=None, dm="AsymmetricRelativeEntropy",
+                 en="TimeFrequency", dp="BasisDiscriminantMeasure", top_k=None,
+                 n_features=None, p=2, n_bins=100, ash_m=5, batch_size=256, n_jobs=1,
+                 backend="process", dtype=np.float64):
+        """
+        Initialize LDB object.
+
+        Arguments:
+        - wt => Wavelet name, as accepted by PyWavelets. Default is "haar".
+            Other examples are "dbN", "coifN", "symN".
+        - max_dec_level => Number of decomposition levels. Default of None
+            means signal decomposes to max level.
+        - dm => Discriminant measure. Default is "AsymmetricRelativeEntropy".
+            Other acceptable values are "SymmetricRelativeEntropy",
+            "LpEntropy" and "HellingerDistance".
+        - en => Energy map. Default is "TimeFrequency". Other acceptable value
+            is "ProbabilityDensity".
+        - dp => Discriminant power measure. Default is
+            "BasisDiscriminantMeasure". Other acceptable values are
+            "FishersClassSeparability" and "RobustFishersClassSeparability".
+        - top_k => Number of coefficients used in each node to determine the
+            discriminant measure. Default of None means all coefficients are
+            used.
+        - n_features => Number of features to be returned in output. Default
+            of None means all features are returned.
+        - p => Exponent of LpEntropy. Default is 2.
+        - n_bins, ash_m => Number of bins and of shifted histograms of the
+            ProbabilityDensity estimates. Default is 100 and 5.
+        - batch_size => Number of signals processed at a time. Default is 256.
+        - n_jobs, backend => Number of workers (-1 uses all cores) and
+            "process" or "thread" pool. Default is 1 (serial).
+        - dtype => Floating point type of the signals. Default is np.float64.
+        """
+        assert dm in DISCRIMINANT_MEASURES, "Unknown discriminant measure %s." % dm
+        assert en in ENERGY_MAPS, "Unknown energy map %s." % en
+        assert dp in DISCRIMINANT_POWERS, "Unknown discriminant power %s." % dp
+        self.wt = wt
+        self.max_dec_level = max_dec_level
+        self.dm = dm
+        self.en = en
+        self.dp = dp
+        self.top_k = top_k
+        self.n_features = n_features
+        self.p = p
+        self.n_bins = n_bins
+        self.ash_m = ash_m
+        self.batch_size = batch_size
+        self.n_jobs = n_jobs
+        self.backend = backend
+        self.dtype = dtype
+
+    def _map(self, func, X, y=None, args=()):
+        """
+        Helper function: apply func to the batches of signals of X (and of
+        labels y) followed by args, yielding the results in order.
+        """
+        def batches():
+            for s in chunk_slices(len(X), self.batch_size):
+                signals = _signal_matrix(X[s], self.dtype)
+                yield ((signals,) if y is None else (signals, y[s])) + args
+        return bounded_starmap(func, batches(), self.n_jobs, self.backend)
+
+    def _energy_map(self, X, y, L):
+        """
+        Helper function: energy map of each class.
+        """
+        n_classes = len(self.classes)
+        if self.en == "TimeFrequency":
+            energy = np.zeros((n_classes, L + 1, self.n))
+            norms = np.zeros(n_classes)
+            for (e, norm) in self._map(_ldb_energy, X, y, (self.wt, L, n_classes)):
+                energy += e
+                norms += norm
+            return (energy / norms[:, None, None]).transpose(2, 1, 0)
+        lo = np.full((L + 1, self.n), np.inf)
+        hi = np.full((L + 1, self.n), -np.inf)
+        for (mn, mx) in self._map(_ldb_range, X, None, (self.wt, L)):
+            np.minimum(lo, mn, out=lo)
+            np.maximum(hi, mx, out=hi)
+        counts = np.zeros((n_classes, L + 1, self.n, self.n_bins), dtype=np.int64)
+        for c in self._map(_ldb_histogram, X, y, (self.wt, L, n_classes, lo, hi, self.n_bins)):
+            counts += c
+        return _ash(counts, self.ash_m).transpose(2, 1, 3, 0)
+
+    def _discriminant_power(self, X, y):
+        """
+        Helper function: discriminant power of each best basis coefficient.
+        """
+        n_classes = len(self.classes)
+        if self.dp == "BasisDiscriminantMeasure":
+            return self.DM[np.arange(self.n), self.levels]
+        if self.dp == "FishersClassSeparability":
+            sums = np.zeros((n_classes, self.n))
+            sqs = np.zeros((n_classes, self.n))
+            for (s, coefs) in zip(chunk_slices(len(X), self.batch_size),
+                                  self._map(_basis_coefs, X, None, (self.wt, self.levels))):
+                for c in np.unique(y[s]):
+                    sums[c] += coefs[y[s] == c].sum(axis=0)
+                    sqs[c] += np.einsum("ij,ij->j", coefs[y[s] == c], coefs[y[s] == c])
+            counts = np.bincount(y, minlength=n_classes)[:, None].astype(np.float64)
+            means = sums / counts
+            variances = np.maximum(sqs - counts * means ** 2, 0.) / np.maximum(counts - 1, 1)
+            center = sums.sum(axis=0) / counts.sum()
+        else:
+            coefs = np.concatenate(list(self._map(_basis_coefs, X, None, (self.wt, self.levels))))
+            counts = np.bincount(y, minlength=n_classes)[:, None].astype(np.float64)
+            means = np.stack([np.median(coefs[y == c], axis=0) for c in range(n_classes)])
+            variances = np.stack([np.median(np.abs(coefs[y == c] - means[c]), axis=0) ** 2
+                                  for c in range(n_classes)])
+            center = np.median(coefs, axis=0)
+        weights = counts / counts.sum()
+        with np.errstate(divide="ignore", invalid="ignore"):
+            DP = (weights * (means - center) ** 2).sum(axis=0) / (weights * variances).sum(axis=0)
+        DP[~np.isfinite(DP)] = 0.
+        return DP
+
+    @traced("NumpyLDB_FeatureExtractor.fit")
+    def fit(self, X, y):
+        """
+        Fits the Local Discriminant Basis feature selection algorithm onto the
+        input images X with labels y.
+        """
+        self.shape = np.shape(X[0])
+        self.n = int(np.prod(self.shape))
+        L = int(np.log2(self.n)) if self.max_dec_level is None else self.max_dec_level
+        assert self.n % 2 ** L == 0, "Signal length must be divisible by 2^max_dec_level."
+        self.classes, y = np.unique(np.asarray(y), return_inverse=True)
+        self.L = L
+        # energy maps and discriminant measures, summed over all pairs of classes
+        self.Gamma = self._energy_map(X, y, L)
+        self.DM = np.zeros((self.n, L + 1))
+        for i in range(len(self.classes) - 1):
+            for j in range(i + 1, len(self.classes)):
+                D = _discriminant_measure(self.Gamma[..., i], self.Gamma[..., j], self.dm, self.p)
+                self.DM += D if D.ndim == 2 else D.sum(axis=2)
+        # best basis
+        self.cost = _node_cost(self.DM, L, self.top_k)
+        self.tree = _best_tree(self.cost, L)
+        self.levels = _basis_levels(self.tree, L, self.n)
+        # discriminant power and ordering
+        self.DP = self._discriminant_power(X, y)
+        self.order = np.argsort(-self.DP, kind="stable")
+        return self
+
+    def _selected(self):
+        """
+        Helper function: positions of the selected best basis coefficients.
+        """
+        return self.order if self.n_features is None else self.order[:self.n_features]
+
+    @traced("NumpyLDB_FeatureExtractor.transform")
+    def transform(self, X, y=None):
+        """
+        Extract the LDB features on signals X.
+
+        Input y is not used, but is included as a parameter by convention and is
+        completely optional.
+        """
+        features = self._selected()
+        Xf = np.empty((len(X), len(features)), dtype=self.dtype)
+        for (s, f) in zip(chunk_slices(len(X), self.batch_size),
+                          self._map(_ldb_features, X, None, (self.wt, self.levels, features))):
+            Xf[s] = f
+        return Xf
+
+    @traced("NumpyLDB_FeatureExtractor.fit_transform")
+    def fit_transform(self, X, y):
+        """
+        Fit and transform the images X with labels y using Local Discriminant
+        Basis.
+        """
+        return self.fit(X, y).transform(X)
+
+    def inverse_transform(self, X, y=None):
+        """
+        Compute the inverse transform on the feature matrix X to form the
+        original images based on the LDB class.
+
+        Input y is not used, but is included as a parameter by convention and is
+        completely optional.
+        """
+        features = self._selected()
+        N = X.shape[0]
+        Xi = np.empty((N, self.n))
+        batches = ((X[s], self.wt, self.tree, self.L, features, self.n) for s in chunk_slices(N, self.batch_size))
+        for (s, signals) in zip(chunk_slices(N, self.batch_size),
+                                bounded_starmap(_ldb_inverse, batches, self.n_jobs, self.backend)):
+            Xi[s] = signals
+        # return as list of images (views)
+        Xi = Xi.reshape((N,) + tuple(self.shape))
+        return [Xi[i] for i in range(N)]
+
+    def change_nfeatures(self, X, n_features):
+        """
+        Change the number of features from self.n_features to n_features.
+
+        Note: if the input n_features is larger than self.n_features, it results
+        in the regeneration of signals based on the current self.n_features
+        before reselecting the features. This will cause additional features to
+        be less accurate and effective.
+        """
+        if n_features <= X.shape[1]:
+            self.n_features = n_features
+            return X[:, :n_features]
+        images = self.inverse_transform(X)
+        self.n_features = n_features
+        return self.transform(images)
@@ -0,0 +1,73 @@
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+def effective_n_jobs(n_jobs):
+    """
+    Resolves the number of workers to use, following the sklearn convention:
+    None or 1 runs serially, -1 uses all cores, -2 all cores but one, etc.
+    """
+    if n_jobs is None:
+        return 1
+    n_cpus = os.cpu_count() or 1
+    if n_jobs < 0:
+        return max(n_cpus + 1 + n_jobs, 1)
+    return max(int(n_jobs), 1)
+
+def make_executor(n_jobs, backend="thread", initializer=None, initargs=()):
+    """
+    Creates a pool of workers.
+
+    Inputs:
+    - n_jobs: number of workers (see effective_n_jobs)
+    - backend: "thread" or "process". Threads are preferred for OpenCV calls as
+        they release the GIL; processes for pure Python/NumPy work.
+    - initializer, initargs: optional per-worker setup function and arguments
+    """
+    n_workers = effective_n_jobs(n_jobs)
+    if backend == "thread":
+        return ThreadPoolExecutor(n_workers, initializer=initializer, initargs=initargs)
+    elif backend == "process":
+        return ProcessPoolExecutor(n_workers, initializer=initializer, initargs=initargs)
+    else:
+        raise ValueError("backend must be either 'thread' or 'process'.")
+
+def chunk_slices(n, chunk_size):
+    """
+    Splits range(n) into consecutive slices of at most `chunk_size` elements.
+    """
+    chunk_size = max(int(chunk_size), 1)
+    return [slice(start, min(start + chunk_size, n)) for start in range(0, n, chunk_size)]
+
+def parallel_map(func, iterable, n_jobs=1, backend="thread", chunksize=1):
+    """
+    Applies `func` to every element of `iterable` and returns the results in
+    input order. Runs serially when n_jobs resolves to 1.
+    """
+    if effective_n_jobs(n_jobs) == 1:
+        return [func(x) for x in iterable]
+    with make_executor(n_jobs, backend) as executor:
+        return list(executor.map(func, iterable, chunksize=chunksize))
+
+def bounded_starmap(func, args_iterable, n_jobs=1, backend="thread", initializer=None, initargs=(), max_pending=None):
+    """
+    Lazily applies `func` to every tuple of arguments of `args_iterable` and
+    yields the results in input order. At most `max_pending` calls (default:
+    two per worker) are in flight at a time, so that only a few inputs and
+    results are held in memory when streaming over batches. Runs serially
+    (without the initializer) when n_jobs resolves to 1.
+    """
+    n_workers = effective_n_jobs(n_jobs)
+    if n_workers == 1:
+        for args in args_iterable:
+            yield func(*args)
+        return
+    max_pending = max_pending or 2 * n_workers
+    with make_executor(n_workers, backend, initializer, initargs) as executor:
+        pending = deque()
+        for args in args_iterable:
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+            pending.append(executor.submit(func, *args))
+        while pending:
+            yield pending.popleft().result()
@@ -1,5 +1,79 @@
+from functools import partial
 from kymatio.sklearn import Scattering2D
 import numpy as np
+from .parallel import effective_n_jobs, chunk_slices, bounded_starmap
+from .instrumentation import traced
+
+# Scattering2D operator of a worker process, see _init_worker()
+_worker_sctr = None
+
+def _filter_bank(sctr):
+    """
+    Helper function: picklable state of a built Scattering2D operator, including its filter bank. The padding
+    functions hold module references and are rebuilt by Scattering2D.build() instead.
+    """
+    return {k: v for (k, v) in vars(sctr).items() if k not in ("pad", "unpad")}
+
+def _init_worker(state):
+    """
+    Helper function: restore the Scattering2D operator of the parent process in a worker process, without recomputing
+    its filter bank.
+    """
+    global _worker_sctr
+    _worker_sctr = Scattering2D.__new__(Scattering2D)
+    _worker_sctr.__dict__.update(state)
+    _worker_sctr.build()
+
+# spatial pooling statistics of the scattering coefficients
+STATS = ("mean", "var", "max", "roi_mean")
+
+def _grid_weights(mask, grid_shape):
+    """
+    Helper function: downsample masks to the scattering grid. Each grid cell is weighted by the fraction of its
+    2^J x 2^J pixels that are in the ROI.
+    :param mask: ndarray with shape (n_samples, n_pixel_x, n_pixel_y), non-zero in the ROI.
+    :param grid_shape: (h, w) shape of the scattering coefficients.
+    :return: float64 ndarray with shape (n_samples, h, w)
+    """
+    n, M, N = mask.shape
+    h, w = grid_shape
+    fy, fx = -(-M // h), -(-N // w)
+    padded = np.zeros((n, h * fy, w * fx))
+    padded[:, :M, :N] = mask != 0
+    return padded.reshape(n, h, fy, w, fx).mean(axis=(2, 4))
+
+def _pool_stats(sctr, batch, stats=("mean", "var"), mask=None):
+    """
+    Helper function: scatter a batch of images and reduce the coefficients of each image to the pooling statistics
+    `stats`, in a single pass over the coefficients: mean and variance come from sums and sums of squares with float64
+    accumulators.
+    :param mask: ndarray of masks of the batch, required by "roi_mean".
+    :return: tuple of ndarrays with shape (n_samples, n_coefficients), one per statistic.
+    """
+    scattering_coefs = sctr.scattering(batch)
+    n, K, h, w = scattering_coefs.shape
+    coefs = scattering_coefs.reshape(n, K, h * w)
+    pooled = {}
+    if "mean" in stats or "var" in stats:
+        mean = coefs.sum(axis=-1, dtype=np.float64) / (h * w)
+        pooled["mean"] = mean
+        if "var" in stats:
+            sq = np.einsum("nkp,nkp->nk", coefs, coefs, dtype=np.float64) / (h * w)
+            pooled["var"] = np.maximum(sq - mean * mean, 0.)
+    if "max" in stats:
+        pooled["max"] = coefs.max(axis=-1)
+    if "roi_mean" in stats:
+        weights = _grid_weights(mask, (h, w))
+        total = weights.sum(axis=(1, 2))
+        roi_sum = np.einsum("nkp,np->nk", coefs, weights.reshape(n, h * w), dtype=np.float64)
+        pooled["roi_mean"] = roi_sum / np.where(total > 0, total, 1.)[:, None]
+    return tuple(pooled[stat].astype(scattering_coefs.dtype, copy=False) for stat in stats)
+
+def _worker_pool_stats(batch, stats, mask):
+    """
+    Helper function: _pool_stats() with the Scattering2D operator of a worker process.
+    """
+    return _pool_stats(_worker_sctr, batch, stats, mask)
 
 class scattering_transform:
     """
@@ -13,54 +87,139 @@ class scattering_transform:
     scales (J) and orientations (L) for wavelet decomposition. The kth layer output has a size of L^k*(J choose k).
     2. For each resulting scattering transformed image with size (M/(2^J), N/(2^J)), calculate the mean and variance.
     For a 2-layer scattering transform operator, the resulting feature vector has a size of 2*(1+JL+L^2*J(J-1)/2).
+    Other spatial pooling statistics can be added: the maximum, and the mean over the ROI (the image_preprocessing
+    mask downsampled to the scattering grid).
+    The images are scattered in batches, and the coefficients of each batch are reduced to their statistics
+    right away, so that peak memory is bounded by the batch size rather than by the number of images. The Scattering2D
+    operator (and its filter bank) is built once and reused across calls, and the batches can be distributed over
+    worker processes, which receive the filter bank once instead of rebuilding it.
 
     """
-    def __init__(self,J,shape,L=8,max_order=2):
+    def __init__(self,J,shape,L=8,max_order=2,batch_size=256,n_jobs=1,backend="process",dtype=None,
+                 stats=("mean","var"),mask=None):
         """
         Constructor of scattering transform feature object.
         :param J(int): log2 of the scattering scale.
         :param shape (tuple of ints): shape of input image.
         :param L(int): number of orientations. Default to 8.
         :param max_order (int): number of layers. Default to 2.
+        :param batch_size (int): number of images scattered at a time. Default to 256.
+        :param n_jobs (int): number of workers scattering the batches. -1 uses all cores. Default to 1.
+        :param backend (str): "process" or "thread" pool of workers. Default to "process".
+        :param dtype: if set (e.g. np.float32), the images are cast to this dtype before being scattered, which also
+        sets the dtype of the features. Default to None (the images are used as they are).
+        :param stats (tuple of str): pooling statistics of the scattering coefficients, among "mean", "var", "max" and
+        "roi_mean". The features are stacked in this order. Default to ("mean","var").
+        :param mask: masks of the images, required by "roi_mean". Must be a list of single-channel arrays, or an
+        ndarray with shape (n_samples,n_pixel_x,n_pixel_y), non-zero in the ROI. It can also be given to transform().
         """
+        for stat in stats:
+            assert stat in STATS, "Unknown pooling statistic %s." % stat
         self.J = J
         self.shape = shape
         self.L = L
         self.max_order = max_order
+        self.batch_size = batch_size
+        self.n_jobs = n_jobs
+        self.backend = backend
+        self.dtype = dtype
+        self.stats = tuple(stats)
+        self.mask = mask
+        self.sctr = None
+
+    def n_coefficients(self):
+        """
+        Number of scattering coefficients of an image: 1+JL for 1 layer, 1+JL+L^2*J(J-1)/2 for 2 layers.
+        """
+        n_coefs = 1 + self.J * self.L
+        if self.max_order == 2:
+            n_coefs += self.L ** 2 * self.J * (self.J - 1) // 2
+        return n_coefs
+
+    def scattering_operator(self):
+        """
+        The Scattering2D operator of the current parameters. It is only built (which computes the filter bank) on the
+        first call or when J, shape, L or max_order have changed.
+        """
+        params = (self.J, tuple(self.shape), self.L, self.max_order)
+        if self.sctr is None or getattr(self, "_sctr_params", None) != params:
+            self.sctr = Scattering2D(J = self.J, shape = self.shape, L = self.L, max_order=self.max_order)
+            self._sctr_params = params
+        return self.sctr
 
+    @traced("scattering_transform.fit")
     def fit(self, X):
         """
-        Fit input images into scattering transform feature object. The input needs to be a list of ndarrays.
-        :param X: a list of single-channel ndarrays. The Scattering2D class requires ndarray with shape
-        (n_samples,n_pixel_x,n_pixel_y) as input, but to keep the input to fit function consistent to other
-        feature extraction modulus, a list is asked for input.
+        Fit input images into scattering transform feature object, i.e. build the Scattering2D operator. No data is
+        stored, the images are only used by transform().
+        :param X: a list of single-channel ndarrays, or an ndarray with shape (n_samples,n_pixel_x,n_pixel_y).
         :return: object, instance itself
         """
-        self.sctr = Scattering2D(J = self.J, shape = self.shape, L = self.L, max_order=self.max_order)
-        # convert list to ndarray
-        self.X = np.stack(X, axis=0)
+        self.scattering_operator()
         return self
 
-    def transform(self, X):
+    def _batches(self, X, mask):
+        """
+        Helper function: yield (slice, batch, mask batch) triples of batch_size images, stacked and cast to dtype.
+        """
+        stack = lambda A, s: np.asarray(A[s]) if isinstance(A, np.ndarray) else np.stack(A[s], axis=0)
+        for s in chunk_slices(len(X), self.batch_size):
+            batch = stack(X, s)
+            if self.dtype is not None:
+                batch = batch.astype(self.dtype, copy=False)
+            yield s, batch, None if mask is None else stack(mask, s)
+
+    def _pooled_batches(self, X, mask):
+        """
+        Helper function: yield (slice, statistics) pairs, computed serially or by a pool of n_jobs workers. At most
+        two batches per worker are in flight at a time.
+        """
+        sctr = self.scattering_operator()
+        if self.backend == "process" and effective_n_jobs(self.n_jobs) > 1:
+            func, initializer, initargs = _worker_pool_stats, _init_worker, (_filter_bank(sctr),)
+        else:
+            func, initializer, initargs = partial(_pool_stats, sctr), None, ()
+        slices = []
+        def args():
+            for (s, batch, mask_batch) in self._batches(X, mask):
+                slices.append(s)
+                yield batch, self.stats, mask_batch
+        pooled = bounded_starmap(func, args(), self.n_jobs, self.backend, initializer, initargs)
+        for (i, stats) in enumerate(pooled):
+            yield slices[i], stats
+
+    @traced("scattering_transform.transform")
+    def transform(self, X, mask=None):
         """
-        Extract scattering transform features from input images. The input needs to be a ndarray.
-        Two steps were included:
+        Extract scattering transform features from input images, batch_size images at a time.
+        Two steps were included for each batch:
         1. Calculate scattering coefficients.
-        2. Calculate mean and variance of each transformed image, rendering scattering transform features.
-        :param X: a single-channel ndarray with shape (n_samples,n_pixel_x,n_pixel_y)
+        2. Calculate the pooling statistics (by default mean and variance) of each transformed image, rendering
+        scattering transform features.
+        :param X: a list of single-channel ndarrays, or an ndarray with shape (n_samples,n_pixel_x,n_pixel_y). The
+        images must be floating point.
+        :param mask: masks of the images for "roi_mean". Default to the mask given to the constructor.
         :return: Extracted scattering transform features. ndarray with shape (n_samples, n_sctr_features)
         """
-        scattering_coefs = self.sctr.scattering(self.X)
-        sctr_features = np.hstack((scattering_coefs.mean(axis=(2, 3)), scattering_coefs.var(axis=(2, 3))))
+        if mask is None:
+            mask = self.mask
+        if "roi_mean" in self.stats:
+            assert mask is not None, "roi_mean requires a mask."
+            assert len(X) == len(mask), "Number of source images and number of masks do not equal."
+        n_coefs = self.n_coefficients()
+        sctr_features = None
+        for (s, pooled) in self._pooled_batches(X, mask):
+            if sctr_features is None:
+                sctr_features = np.empty((len(X), len(pooled) * n_coefs), dtype=pooled[0].dtype)
+            for (i, values) in enumerate(pooled):
+                sctr_features[s, i * n_coefs:(i + 1) * n_coefs] = values
+        if sctr_features is None:
+            sctr_features = np.empty((0, len(self.stats) * n_coefs))
         return sctr_features
 
-    def fit_transform(self, X):
+    @traced("scattering_transform.fit_transform")
+    def fit_transform(self, X, mask=None):
         """
         Combine fit() and transform().
         """
-        # convert list to ndarray
-        self.X = np.stack(X, axis=0)
-        self.sctr = Scattering2D(J=self.J, shape=self.shape, L=self.L, max_order=self.max_order)
-        scattering_coefs = self.sctr.scattering(self.X)
-        sctr_features = np.hstack((scattering_coefs.mean(axis=(2, 3)), scattering_coefs.var(axis=(2, 3))))
-        return sctr_features
\ No newline at end of file
+        return self.fit(X).transform(X, mask)
\ No newline at end of file
@@ -1,6 +1,56 @@
+import json
 import cv2
 import numpy as np
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from .parallel import effective_n_jobs, make_executor, chunk_slices
+from .instrumentation import traced
+
+def _sift_descriptors(X, params):
+    """
+    Helper function: compute the SIFT descriptors of a shard of images with a SIFT object created from `params`.
+    Keypoints are dropped as soon as the descriptors of their image are computed.
+
+    Returns a tuple (des, counts), where des is a float32 array of shape (n_descriptors, 128)
+    holding the descriptors of all images in order, and counts is the number of descriptors
+    of each image.
+    """
+    sift = cv2.xfeatures2d.SIFT_create(**params)
+    counts = np.zeros(len(X), dtype=np.int64)
+    des_list = []
+    for (i, img) in enumerate(X):
+        kp = sift.detect(img, None)
+        _, de = sift.compute(img, kp)
+        del kp
+        if de is not None:
+            de = de.reshape(-1, 128)
+            des_list.append(de)
+            counts[i] = len(de)
+    des = np.concatenate(des_list).astype(np.float32, copy=False) if des_list else np.empty((0, 128), np.float32)
+    return des, counts
+
+def nearest_centroid(des, centers, chunk_size=65536):
+    """
+    Assign descriptors to their nearest centroids. The squared distances are computed as
+    |c|^2 - 2 x.c (|x|^2 does not change the nearest centroid), with float32 matrix
+    multiplications over chunks of chunk_size descriptors.
+
+    Inputs:
+    - des: array of descriptors of shape (n_descriptors, 128)
+    - centers: array of centroids of shape (n_clusters, 128)
+    - chunk_size: number of descriptors per matrix multiplication, default=65536
+
+    Returns the int64 index of the nearest centroid of each descriptor.
+    """
+    centers = np.asarray(centers, dtype=np.float32)
+    c2 = np.einsum("ij,ij->i", centers, centers)
+    labs = np.empty(len(des), dtype=np.int64)
+    for start in range(0, len(des), chunk_size):
+        x = np.asarray(des[start:start+chunk_size], dtype=np.float32)
+        d = x @ centers.T
+        d *= -2
+        d += c2
+        labs[start:start+len(x)] = d.argmin(axis=1)
+    return labs
 
 class SIFT_FeatureExtractor:
     """
@@ -17,9 +67,21 @@ class SIFT_FeatureExtractor:
 
     - sift_nfeatures => default=0 (all features used)
     - kmeans_nclusters => default=5
+    - n_jobs => number of workers running SIFT, default=1 (-1 uses all cores)
+    - backend => "thread" (default) or "process" pool of workers
+    - shard_size => number of images handed to a worker at a time, default=256
+    - codebook => "kmeans" (default) fits k-means on all training descriptors at once,
+      "minibatch" streams the descriptors through mini-batch k-means, so that the
+      codebook is trained within fixed memory
+    - kmeans_batch_size => number of descriptors per mini-batch, default=10000
+    - max_descriptors_per_image => if set, the codebook is trained on a random subsample
+      of at most this many descriptors per image, default=None (all descriptors)
+    - random_state => seed of the subsampling and of k-means, default=None
     """
     def __init__(self, sift_nfeatures=0, sift_nOctaveLayers=3, sift_contrastThreshold=0.04,
-                 sift_edgeThreshold=10, sift_sigma=1.6, kmeans_nclusters=5):
+                 sift_edgeThreshold=10, sift_sigma=1.6, kmeans_nclusters=5, n_jobs=1,
+                 backend="thread", shard_size=256, codebook="kmeans", kmeans_batch_size=10000,
+                 max_descriptors_per_image=None, random_state=None):
         """
         Constructor for the SIFT Feature Extractor object.
         """
@@ -29,7 +91,166 @@ class SIFT_FeatureExtractor:
         self.sift_edgeThreshold = sift_edgeThreshold
         self.sift_sigma = sift_sigma
         self.kmeans_nclusters = kmeans_nclusters
+        self.n_jobs = n_jobs
+        self.backend = backend
+        self.shard_size = shard_size
+        self.codebook = codebook
+        self.kmeans_batch_size = kmeans_batch_size
+        self.max_descriptors_per_image = max_descriptors_per_image
+        self.random_state = random_state
+
+    def sift_params(self):
+        """
+        Parameters of the SIFT object, as keyword arguments of cv2.xfeatures2d.SIFT_create.
+        """
+        return dict(nfeatures=self.sift_nfeatures,
+                    nOctaveLayers=self.sift_nOctaveLayers,
+                    contrastThreshold=self.sift_contrastThreshold,
+                    edgeThreshold=self.sift_edgeThreshold,
+                    sigma=self.sift_sigma)
+
+    @traced("SIFT_FeatureExtractor.extract_descriptors")
+    def extract_descriptors(self, X, params=None):
+        """
+        Compute the SIFT descriptors of images X. The images are split into shards of
+        shard_size images, which are processed by a pool of n_jobs workers, each creating its
+        own SIFT object.
+
+        Inputs:
+        - X: list of images
+        - params: keyword arguments of cv2.xfeatures2d.SIFT_create, default is sift_params()
+
+        Returns a tuple (des, offsets), where des is a float32 array of shape
+        (n_descriptors, 128) and the descriptors of image i are des[offsets[i]:offsets[i+1]].
+        """
+        if params is None:
+            params = self.sift_params()
+        shards = chunk_slices(len(X), self.shard_size)
+        if effective_n_jobs(self.n_jobs) == 1:
+            results = [_sift_descriptors(X[s], params) for s in shards]
+        else:
+            with make_executor(self.n_jobs, self.backend) as executor:
+                results = list(executor.map(_sift_descriptors, [X[s] for s in shards], [params]*len(shards)))
+        offsets = np.zeros(len(X) + 1, dtype=np.int64)
+        for (s, (_, counts)) in zip(shards, results):
+            offsets[s.start+1:s.stop+1] = counts
+        np.cumsum(offsets, out=offsets)
+        des = np.empty((offsets[-1], 128), dtype=np.float32)
+        for (s, (de, _)) in zip(shards, results):
+            des[offsets[s.start]:offsets[s.stop]] = de
+        return des, offsets
+
+    def bag_of_features(self, des, offsets):
+        """
+        Build the Bag of Features (BoF) "barplots" of images from their descriptors. All
+        descriptors are assigned to their nearest clusters in a single batch, then the
+        number of descriptors of each image found in each cluster is counted.
+
+        Inputs:
+        - des: float32 array of descriptors of shape (n_descriptors, 128)
+        - offsets: the descriptors of image i are des[offsets[i]:offsets[i+1]]
+
+        Returns a matrix of shape (n_images, kmeans_nclusters).
+        """
+        n = len(offsets) - 1
+        k = self.kmeans_nclusters
+        if len(des) == 0:
+            return np.zeros((n, k))
+        labs = nearest_centroid(des, self.cluster_centers_)
+        img = np.repeat(np.arange(n), np.diff(offsets))
+        return np.bincount(img * k + labs, minlength=n * k).reshape(n, k).astype(np.float64)
 
+    def subsample_descriptors(self, des, offsets, rng):
+        """
+        Keep a random subsample of at most max_descriptors_per_image descriptors of each
+        image. One random number is drawn per descriptor, so that the subsample does not
+        depend on how the images are batched.
+
+        Inputs:
+        - des, offsets: descriptors of the images (see extract_descriptors())
+        - rng: numpy random Generator
+
+        Returns the float32 array of the kept descriptors.
+        """
+        cap = self.max_descriptors_per_image
+        if cap is None:
+            return des
+        img = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+        order = np.lexsort((rng.random(len(des)), img))
+        rank = np.arange(len(des)) - offsets[img]
+        return des[np.sort(order[rank < cap])]
+
+    @traced("SIFT_FeatureExtractor.fit_codebook", items=None)
+    def fit_codebook(self, batches):
+        """
+        Fit the k-means codebook on batches of descriptors.
+
+        Inputs:
+        - batches: iterable of float32 arrays of descriptors of shape (n_descriptors, 128)
+        """
+        k = self.kmeans_nclusters
+        if self.codebook == "kmeans":
+            des = np.concatenate(list(batches))
+            self.kmeans = KMeans(n_clusters=k, random_state=self.random_state)
+            self.kmeans.fit(des.astype(np.float64))
+        elif self.codebook == "minibatch":
+            self.kmeans = MiniBatchKMeans(n_clusters=k, batch_size=self.kmeans_batch_size,
+                                          random_state=self.random_state)
+            batch_size = max(self.kmeans_batch_size, k)
+            pending = np.empty((0, 128), dtype=np.float32)
+            for des in batches:
+                pending = np.concatenate([pending, des])
+                while len(pending) >= batch_size:
+                    self.kmeans.partial_fit(pending[:batch_size].astype(np.float64))
+                    pending = pending[batch_size:]
+            if len(pending) and (hasattr(self.kmeans, "cluster_centers_") or len(pending) >= k):
+                self.kmeans.partial_fit(pending.astype(np.float64))
+            if not hasattr(self.kmeans, "cluster_centers_"):
+                raise Exception("Not enough descriptors to fit %d clusters." % k)
+        else:
+            raise ValueError("codebook must be either 'kmeans' or 'minibatch'.")
+        self.cluster_centers_ = self.kmeans.cluster_centers_.astype(np.float32)
+
+    def save_vocabulary(self, path):
+        """
+        Save the fitted codebook (float32 centroids) and the SIFT parameters into a .npz file,
+        so that the features can be computed without refitting, see load_vocabulary().
+
+        Inputs:
+        - path: path of the .npz file
+        """
+        if not hasattr(self, "cluster_centers_"):
+            raise Exception("SIFT_FeatureExtractor is not fitted yet.")
+        np.savez(path, cluster_centers=self.cluster_centers_, sift_params=json.dumps(self.sift_params()))
+
+    @classmethod
+    def load_vocabulary(cls, path, **kwargs):
+        """
+        Create a fitted SIFT_FeatureExtractor from a codebook saved by save_vocabulary().
+
+        Inputs:
+        - path: path of the .npz file
+        - kwargs: other constructor parameters (e.g. n_jobs, backend)
+        """
+        with np.load(path) as f:
+            centers = f["cluster_centers"]
+            params = json.loads(str(f["sift_params"]))
+        extractor = cls(**{"sift_" + k: v for (k, v) in params.items()},
+                        kmeans_nclusters=len(centers), **kwargs)
+        extractor.sift = cv2.xfeatures2d.SIFT_create(**extractor.sift_params())
+        extractor.cluster_centers_ = centers
+        return extractor
+
+    def _descriptor_batches(self, X, rng):
+        """
+        Helper function: yield the (subsampled) descriptors of X, computed a few shards at a time.
+        """
+        n_images = self.shard_size * effective_n_jobs(self.n_jobs)
+        for s in chunk_slices(len(X), n_images):
+            des, offsets = self.extract_descriptors(X[s])
+            yield self.subsample_descriptors(des, offsets, rng)
+
+    @traced("SIFT_FeatureExtractor.fit")
     def fit(self, X):
         """
         Fit images into SIFT_FeatureExtractor. Input images should be in the form of a list 
@@ -38,29 +259,12 @@ class SIFT_FeatureExtractor:
         1. Using SIFT to extract keypoints and descriptors of each image.
         2. Using k-means to cluster the descriptors.
         """
-        # SIFT feature extraction
-        self.sift = cv2.xfeatures2d.SIFT_create(
-            nfeatures=self.sift_nfeatures,
-            nOctaveLayers=self.sift_nOctaveLayers,
-            contrastThreshold=self.sift_contrastThreshold,
-            edgeThreshold=self.sift_edgeThreshold,
-            sigma=self.sift_sigma
-        )
-        kp = self.sift.detect(X, None)
-        kp, des = self.sift.compute(X, kp)
-        # stack all descriptors
-        des_all = np.empty(shape=(0,128), dtype=np.float64)
-        for de in des:
-            if de is None:
-                pass
-            elif de.ndim == 1:
-                des_all = np.append(des_all, [de], axis=0)
-            else:
-                des_all = np.append(des_all, de, axis=0)
-        # K-Means clustering of features
-        self.kmeans = KMeans(n_clusters=self.kmeans_nclusters)
-        self.kmeans.fit(des_all)
+        # SIFT feature extraction and k-means clustering of features, a few shards at a time
+        self.sift = cv2.xfeatures2d.SIFT_create(**self.sift_params())
+        rng = np.random.default_rng(self.random_state)
+        self.fit_codebook(self._descriptor_batches(X, rng))
 
+    @traced("SIFT_FeatureExtractor.transform")
     def transform(self, X):
         """
         Transform images into its Bag of Features (BoF) "barplots". Input images should be
@@ -77,20 +281,10 @@ class SIFT_FeatureExtractor:
         the training data.
         """
         # SIFT feature extraction
-        kp = self.sift.detect(X, None)
-        kp, des = self.sift.compute(X, kp)
-        n = len(X)
-        Xt = np.zeros((n, self.kmeans_nclusters))
-        # data transformation for each image
-        for (i, de) in enumerate(des):
-            labs = self.kmeans.predict(de.astype(np.float64)) if de is not None else []
-            v, c = np.unique(labs, return_counts=True)
-            for j in range(self.kmeans_nclusters):
-                if j in v:
-                    idx = np.where(v == j)
-                    Xt[i,j] = c[idx[0][0]]
-        return Xt
+        des, offsets = self.extract_descriptors(X)
+        return self.bag_of_features(des, offsets)
 
+    @traced("SIFT_FeatureExtractor.fit_transform")
     def fit_transform(self, X):
         """
         Fit and transform the images into its Bag of Features (BoF) "barplots". Input images
@@ -104,31 +298,11 @@ class SIFT_FeatureExtractor:
         cluster.
         5. The results are stored in a matrix and output as transformed data.
         """
-         # SIFT feature extraction
-        self.sift = cv2.xfeatures2d.SIFT_create(nfeatures=self.sift_nfeatures)
-        kp = self.sift.detect(X, None)
-        kp, des = self.sift.compute(X, kp)
-        # stack all descriptors
-        des_all = np.empty(shape=(0,128), dtype=np.float64)
-        for de in des:
-            if de is None:
-                pass
-            elif de.ndim == 1:
-                des_all = np.append(des_all, [de], axis=0)
-            else:
-                des_all = np.append(des_all, de, axis=0)
+        # SIFT feature extraction, with the same SIFT parameters as fit()
+        self.sift = cv2.xfeatures2d.SIFT_create(**self.sift_params())
+        des, offsets = self.extract_descriptors(X)
         # K-Means clustering of features
-        self.kmeans = KMeans(n_clusters=self.kmeans_nclusters)
-        self.kmeans.fit(des_all)
-        n = len(X)
-        Xt = np.zeros((n, self.kmeans_nclusters))
-        # data transformation for each image
-        for (i, de) in enumerate(des):
-            labs = self.kmeans.predict(de.astype(np.float64)) if de is not None else []
-            v, c = np.unique(labs, return_counts=True)
-            for j in range(self.kmeans_nclusters):
-                if j in v:
-                    idx = np.where(v == j)
-                    Xt[i,j] = c[idx[0][0]]
-        return Xt
+        rng = np.random.default_rng(self.random_state)
+        self.fit_codebook([self.subsample_descriptors(des, offsets, rng)])
+        return self.bag_of_features(des, offsets)
         
\ No newline at end of file
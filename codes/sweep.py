@@ -0,0 +1,208 @@
+import time
+import numpy as np
+from .haralick import haralick
+from .scattering_transform import scattering_transform
+from .sift import SIFT_FeatureExtractor
+from .swt import SWT_FeatureExtractor
+from .instrumentation import traced
+
+def swt_levels(X, n_levels, wt="haar", batch_size=1024):
+    """
+    SWT features of the images X for several numbers of decomposition levels. Level j of a SWT does not depend on the
+    number of levels, so the images are decomposed once at the largest level, whose features are ordered from the
+    coarsest level to the finest, and the features of n levels are its last n blocks of columns.
+    :param X: a list of single-channel arrays, or an ndarray with shape (n_samples, H, W).
+    :param n_levels: (list of int) numbers of decomposition levels.
+    :param wt: (str) wavelet type.
+    :param batch_size: (int) number of images decomposed at a time.
+    :return: dict mapping each number of levels to its feature matrix, as SWT_FeatureExtractor(wt, n).transform(X).
+    """
+    top = max(n_levels)
+    features = SWT_FeatureExtractor(wt, top, batch_size).transform(X)
+    width = features.shape[1] // top
+    return {n: features[:, (top - n) * width:] for n in n_levels}
+
+def haralick_distances(X, distances, **kwargs):
+    """
+    Haralick features of the images X for several sets of distances. The features of each distance are independent
+    columns, so they are computed once for the union of the distances and each set takes its columns.
+    :param X: a list of single-channel arrays, or an ndarray with shape (n_samples, H, W).
+    :param distances: a list of iterables of integers, the distance parameter of each grid point.
+    :param kwargs: other parameters of haralick (ignore_zeros, n_jobs, engine, ...).
+    :return: dict mapping each set of distances (as a tuple) to its feature matrix, as haralick(d).transform(X).
+    """
+    union = sorted(set(d for dist in distances for d in dist))
+    features = haralick(union, **kwargs).transform(X)
+    position = {d: j for (j, d) in enumerate(union)}
+    result = {}
+    for dist in distances:
+        cols = np.concatenate([np.arange(52 * position[d], 52 * (position[d] + 1)) for d in dist])
+        result[tuple(dist)] = features[:, cols]
+    return result
+
+def sift_codebooks(X, kmeans_nclusters, X_fit=None, **kwargs):
+    """
+    SIFT Bag of Features of the images X for several codebook sizes. The descriptors are extracted once, each codebook
+    is fitted on the same (subsampled) descriptors, and the descriptors of X are assigned to every codebook.
+    :param X: a list of single-channel arrays, or an ndarray with shape (n_samples, H, W).
+    :param kmeans_nclusters: (list of int) codebook sizes.
+    :param X_fit: images the codebooks are fitted on. Default to X (as SIFT_FeatureExtractor.fit_transform(X)).
+    :param kwargs: other parameters of SIFT_FeatureExtractor.
+    :return: tuple (features, extractors) of dicts mapping each codebook size to its feature matrix and to its fitted
+    SIFT_FeatureExtractor.
+    """
+    base = SIFT_FeatureExtractor(**kwargs)
+    des, offsets = base.extract_descriptors(X)
+    if X_fit is None:
+        des_fit, offsets_fit = des, offsets
+    else:
+        des_fit, offsets_fit = base.extract_descriptors(X_fit)
+    # one random number per descriptor, so subsampling the whole set equals the batched subsampling of fit()
+    sample = base.subsample_descriptors(des_fit, offsets_fit, np.random.default_rng(base.random_state))
+    features, extractors = {}, {}
+    for k in kmeans_nclusters:
+        extractor = SIFT_FeatureExtractor(**dict(kwargs, kmeans_nclusters=k))
+        extractor.fit_codebook([sample])
+        features[k] = extractor.bag_of_features(des, offsets)
+        extractors[k] = extractor
+    return features, extractors
+
+def scattering_scales(X, J, dtype=np.float64, **kwargs):
+    """
+    Scattering transform features of the images X for several scales J. The scattering coefficients of different
+    scales do not nest, so only the input is shared: the images are stacked and cast once for all scales.
+    :param X: a list of single-channel arrays, or an ndarray with shape (n_samples, H, W).
+    :param J: (list of int) scales.
+    :param dtype: dtype of the images and features. Default to np.float64.
+    :param kwargs: other parameters of scattering_transform (L, max_order, stats, mask, n_jobs, ...).
+    :return: dict mapping each scale to its feature matrix.
+    """
+    Xf = np.asarray(X if isinstance(X, np.ndarray) else np.stack(X, axis=0), dtype=dtype)
+    return {j: scattering_transform(j, Xf.shape[1:], dtype=dtype, **kwargs).fit_transform(Xf) for j in J}
+
+
+def _swt_point(X, n_levels, kwargs):
+    return SWT_FeatureExtractor(n_levels=n_levels, **kwargs).fit_transform(X)
+
+def _haralick_point(X, distance, kwargs):
+    return haralick(distance, **kwargs).transform(X)
+
+def _sift_sweep(X, kmeans_nclusters, **kwargs):
+    return sift_codebooks(X, kmeans_nclusters, **kwargs)[0]
+
+def _sift_point(X, kmeans_nclusters, kwargs):
+    return SIFT_FeatureExtractor(kmeans_nclusters=kmeans_nclusters, **kwargs).fit_transform(X)
+
+def _scattering_point(X, J, kwargs):
+    kwargs = dict(kwargs)
+    dtype = kwargs.pop("dtype", np.float64)
+    Xf = np.asarray(X, dtype=dtype)
+    return scattering_transform(J, Xf.shape[1:], dtype=dtype, **kwargs).fit_transform(Xf)
+
+# swept parameter of each extractor, the function computing all its grid points from shared intermediates, and the
+# function computing one grid point with a naive refit
+SWEEPS = {"swt": ("n_levels", swt_levels, _swt_point),
+          "haralick": ("distance", haralick_distances, _haralick_point),
+          "sift": ("kmeans_nclusters", _sift_sweep, _sift_point),
+          "scattering": ("J", scattering_scales, _scattering_point)}
+
+
+class FeatureSweep:
+    """
+    Features of every grid point of parameter grids of SWT_FeatureExtractor (n_levels), haralick (distance),
+    SIFT_FeatureExtractor (kmeans_nclusters) and scattering_transform (J), computed from intermediates shared by the
+    grid points (see swt_levels, haralick_distances, sift_codebooks and scattering_scales) instead of one refit per grid
+    point. The time of the sweep is compared with the time of naive refits, estimated by refitting every grid point on
+    random probe subsets of two sizes and extrapolating a fixed plus per-image cost to the number of images, see
+    report().
+    """
+    def __init__(self, grids, probe_size=64, random_state=None):
+        """
+        Constructor of the feature sweep.
+        :param grids: dict mapping 'swt', 'haralick', 'sift' or 'scattering' to a dict of constructor parameters, in
+        which the swept parameter (n_levels, distance, kmeans_nclusters or J) is a list of values, e.g.
+        {'swt': {'n_levels': [1, 2, 3]}, 'sift': {'kmeans_nclusters': [5, 10, 20], 'random_state': 0}}
+        :param probe_size: (int) number of images used to estimate the time of naive refits. 0 or None skips the
+        estimate.
+        :param random_state: seed of the probe subset.
+        """
+        for (name, grid) in grids.items():
+            assert name in SWEEPS, "Unknown extractor %s." % name
+            assert SWEEPS[name][0] in grid, "The grid of %s must list %s." % (name, SWEEPS[name][0])
+        self.grids = grids
+        self.probe_size = probe_size
+        self.random_state = random_state
+
+    @traced("FeatureSweep.run")
+    def run(self, X):
+        """
+        Compute the features of every grid point.
+        :param X: a list of single-channel arrays, or an ndarray with shape (n_samples, H, W).
+        :return: dict mapping each extractor name to a dict mapping each value of its swept parameter (tuples for
+        distance sets) to the feature matrix of X.
+        """
+        self.features_ = {}
+        self.sweep_time_ = {}
+        self.naive_time_ = {}
+        for (name, grid) in self.grids.items():
+            param, sweep, _ = SWEEPS[name]
+            kwargs = {k: v for (k, v) in grid.items() if k != param}
+            start = time.perf_counter()
+            self.features_[name] = sweep(X, grid[param], **kwargs)
+            self.sweep_time_[name] = time.perf_counter() - start
+            if self.probe_size:
+                self.naive_time_[name] = self._naive_time(X, name, grid[param], kwargs)
+        return self.features_
+
+    def _naive_time(self, X, name, values, kwargs, repeat=2):
+        """
+        Helper function: estimated time of refitting the extractor at every grid point on all images X. The refits are
+        timed (best of `repeat` runs) on random probe subsets of 1 and probe_size images, and the time is modeled as
+        a fixed cost (e.g. building filter banks) plus a cost per image, so that fixed costs are not scaled with the
+        number of images. When the probe covers all images, the measured time is returned. When a refit on one image is
+        invalid (e.g. fewer SIFT descriptors than clusters), the time on probe_size images is scaled to all images.
+        """
+        naive = SWEEPS[name][2]
+        n = len(X)
+        rng = np.random.default_rng(self.random_state)
+        m2 = min(self.probe_size, n)
+        m1 = 1
+        idx = rng.permutation(n)[:m2]
+        def timed(m):
+            sub = np.sort(idx[:m])
+            probe = X[sub] if isinstance(X, np.ndarray) else [X[i] for i in sub]
+            best = None
+            for _ in range(repeat):
+                start = time.perf_counter()
+                for v in values:
+                    naive(probe, v, kwargs)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            return best
+        t2 = timed(m2)
+        if m2 == n or m1 == m2:
+            return t2 * n / m2
+        try:
+            t1 = timed(m1)
+        except ValueError:
+            return t2 * n / m2
+        per_image = max((t2 - t1) / (m2 - m1), 0.)
+        fixed = max(t2 - per_image * m2, 0.)
+        return fixed + per_image * n
+
+    def report(self):
+        """
+        Summary of the sweep.
+        :return: dict mapping each extractor name to its number of grid points, the time of the sweep, the estimated
+        time of naive refits and the estimated time saved (None without estimate).
+        """
+        if not hasattr(self, "features_"):
+            raise Exception("FeatureSweep has not been run yet.")
+        summary = {}
+        for (name, features) in self.features_.items():
+            naive = self.naive_time_.get(name)
+            summary[name] = {"grid_points": len(features),
+                             "sweep_time": self.sweep_time_[name],
+                             "estimated_naive_time": naive,
+                             "estimated_time_saved": None if naive is None else naive - self.sweep_time_[name]}
+        return summary
@@ -1,6 +1,19 @@
 import pywt
 import numpy as np
+from functools import lru_cache
 from scipy.fftpack import dct
+from .instrumentation import traced
+
+@lru_cache(maxsize=None)
+def _partial_dct_basis(n, step=8):
+    """
+    Rows of the orthonormal DCT-II matrix of size n that are kept by the feature extractor, i.e. every `step`-th
+    coefficient. For a matrix M, basis(H) @ M @ basis(W).T equals dct(dct(M, axis=0), axis=1)[::step, ::step].
+    """
+    D = dct(np.eye(n), 2, axis=0, norm="ortho")
+    D = np.ascontiguousarray(D[::step])
+    D.flags.writeable = False
+    return D
 
 class SWT_FeatureExtractor:
     """
@@ -13,20 +26,24 @@ class SWT_FeatureExtractor:
     coefficients.
     3. Reshape and output the results as 1D vectors.
     """
-    def __init__(self, wt="haar", n_levels=1):
+    def __init__(self, wt="haar", n_levels=1, batch_size=1024):
         """
         Initializer for the feature extractor. Specify the number of wavelet type and 
-        decomposition levels, default is set as wt="haar" and n_levels=1.
+        decomposition levels, default is set as wt="haar" and n_levels=1. Images are 
+        transformed in batches of batch_size images.
         """
         self.wt = wt
         self.n_levels = n_levels
+        self.batch_size = batch_size
 
+    @traced("SWT_FeatureExtractor.fit")
     def fit(self, X=None, y=None):
         """
         Dummy function. Created for the conventional purpose of using Pipeline in sklearn.
         """
         return None
 
+    @traced("SWT_FeatureExtractor.transform")
     def transform(self, X, y=None):
         """
         Exactly the same function as fit_transform. Used as a wrapper for fit_transform and
@@ -34,18 +51,32 @@ class SWT_FeatureExtractor:
         """
         return self.fit_transform(X)
 
+    @traced("SWT_FeatureExtractor.fit_transform")
     def fit_transform(self, X, y=None):
         """
-        Perform data transformation
+        Perform data transformation. Each batch of images is stacked and decomposed with
+        one SWT call over the image axes. Only the DCT coefficients that are kept (every 
+        8th coefficient along each axis) are computed, as a product with the matching 
+        rows of the DCT matrix.
         """
-        Xt = np.empty((len(X), 192*self.n_levels))
-        for (i, img) in enumerate(X):
-            _, *Xw = pywt.swt2(img, self.wt, self.n_levels, start_level=0, trim_approx=True)
+        n = len(X)
+        if n == 0:
+            # the image size is unknown, assume 64x64 images (192 features per level)
+            return np.empty((0, 192*self.n_levels))
+        H, W = np.shape(X[0])
+        DH = _partial_dct_basis(H)
+        DW = _partial_dct_basis(W)
+        n_coefs = DH.shape[0] * DW.shape[0]
+        Xt = np.empty((n, 3*n_coefs*self.n_levels))
+        for start in range(0, n, self.batch_size):
+            end = min(start + self.batch_size, n)
+            batch = np.asarray(X[start:end], dtype=np.float64)
+            _, *Xw = pywt.swt2(batch, self.wt, self.n_levels, start_level=0, trim_approx=True, axes=(-2, -1))
             # counter to track column of Xt
             counter = 0
             for detail_coefs in Xw:
                 for mat in detail_coefs:
-                    dmat = dct(dct(mat, 2, axis=0, norm="ortho"), 2, axis=1, norm="ortho")
-                    Xt[i,counter:(counter+64)] = dmat[::8, ::8].reshape(-1)
-                    counter += 64
+                    dmat = DH @ mat @ DW.T
+                    Xt[start:end, counter:(counter+n_coefs)] = dmat.reshape(end - start, -1)
+                    counter += n_coefs
         return Xt
@@ -0,0 +1,199 @@
+import numpy as np
+from .parallel import effective_n_jobs, make_executor, chunk_slices
+from .instrumentation import traced
+from .feature_cache import CachedExtractor
+
+# extractors whose transform accepts per-image masks (transform(X, mask))
+MASKED = ("IntensityMeasure", "scattering_transform")
+# extractors fitted with the labels (fit(X, y))
+SUPERVISED = ("LDB_FeatureExtractor", "NumpyLDB_FeatureExtractor")
+# extractors whose fit reads the images. The others only check or ignore them, so they are fitted on the images
+# without casting
+DATA_FITS = ("SIFT_FeatureExtractor", "LDB_FeatureExtractor", "NumpyLDB_FeatureExtractor")
+# floating point input expected by each extractor, when it has no dtype attribute of its own
+INPUT_DTYPES = {"SWT_FeatureExtractor": np.float64,
+                "scattering_transform": np.float64,
+                "LDB_FeatureExtractor": np.float64,
+                "NumpyLDB_FeatureExtractor": np.float64}
+
+def _unwrap(extractor):
+    """
+    Helper function: the extractor wrapped by a CachedExtractor, or the extractor itself.
+    """
+    return extractor.extractor if isinstance(extractor, CachedExtractor) else extractor
+
+def _stack(X):
+    """
+    Helper function: a list of single-channel arrays as an ndarray with shape (n_samples, H, W).
+    """
+    return X if isinstance(X, np.ndarray) else np.stack(X, axis=0)
+
+
+class FeatureUnion:
+    """
+    Concatenate the features of several extractors (haralick, IntensityMeasure, SWT_FeatureExtractor,
+    SIFT_FeatureExtractor, scattering_transform, LDB_FeatureExtractor, NumpyLDB_FeatureExtractor or CachedExtractor)
+    in one pass over the images. The images are preprocessed (optionally), stacked and cast once per chunk of
+    chunk_size images, every extractor transforms the chunk, and the features are written into one preallocated
+    matrix, in which each extractor owns the column range columns_[name]. Masks are handed to the extractors that
+    accept them (see MASKED). Extractors wrapped in a CachedExtractor are treated as the extractor they wrap.
+    """
+    def __init__(self, extractors, names=None, preprocessing=None, image_output="normalized", chunk_size=1024,
+                 n_jobs=1):
+        """
+        Constructor of the feature union.
+        :param extractors: a list of configured feature extractor objects.
+        :param names: (list of str) names of the extractors, keys of columns_. Default to their class names, numbered
+        when a class appears more than once.
+        :param preprocessing: an optional preprocessing_pipeline object. If given, the inputs are multi-channel images
+        that are preprocessed chunk by chunk, and its 'mask' output (if requested) is handed to the masked extractors.
+        :param image_output: (str) output of the preprocessing pipeline fed to the extractors. Default to 'normalized'.
+        :param chunk_size: (int) number of images processed in one pass.
+        :param n_jobs: (int) number of threads running the extractors concurrently on a chunk. Default to 1 (one
+        extractor after the other). Extractors with their own n_jobs still use their own pools.
+        """
+        if names is None:
+            names = [type(e).__name__ for e in extractors]
+            names = [n if names.count(n) == 1 else "%s_%d" % (n, names[:i].count(n)) for (i, n) in enumerate(names)]
+        assert len(names) == len(extractors), "Number of names and number of extractors do not equal."
+        assert len(set(names)) == len(names), "Extractor names must be unique."
+        if preprocessing is not None:
+            assert image_output in preprocessing.outputs, "The preprocessing pipeline must output " + image_output
+        self.extractors = list(extractors)
+        self.names = list(names)
+        self.preprocessing = preprocessing
+        self.image_output = image_output
+        self.chunk_size = chunk_size
+        self.n_jobs = n_jobs
+
+    def _input_dtype(self, extractor):
+        """
+        Helper function: dtype of the images given to an extractor, None to give the images unchanged.
+        """
+        extractor = _unwrap(extractor)
+        name = type(extractor).__name__
+        dtype = getattr(extractor, "dtype", None)
+        if dtype is None:
+            dtype = INPUT_DTYPES.get(name)
+        return None if dtype is None else np.dtype(dtype)
+
+    @traced("FeatureUnion.fit")
+    def fit(self, X, y=None):
+        """
+        Fit every extractor on the images X. The images are preprocessed once for all extractors, and cast once per
+        dtype for the extractors whose fit reads them.
+        :param X: a list of single-channel arrays or an ndarray with shape (n_samples, H, W), or multi-channel images
+        if a preprocessing pipeline was given.
+        :param y: labels of X, required by the supervised extractors (see SUPERVISED).
+        :return: object, instance itself
+        """
+        if self.preprocessing is not None:
+            X = self.preprocessing.transform(X)[self.image_output]
+        self._fit(_stack(X), y)
+        return self
+
+    def _fit(self, X, y):
+        """
+        Helper function: fit every extractor on the preprocessed images X, cast only for the extractors whose fit
+        reads them (see DATA_FITS).
+        """
+        cast = {}
+        for e in self.extractors:
+            dtype = self._input_dtype(e) if type(_unwrap(e)).__name__ in DATA_FITS else None
+            if dtype is not None and dtype not in cast:
+                cast[dtype] = X.astype(dtype, copy=False)
+            Xe = X if dtype is None else cast[dtype]
+            if type(_unwrap(e)).__name__ in SUPERVISED:
+                assert y is not None, type(e).__name__ + " requires labels."
+                e.fit(Xe, y)
+            else:
+                e.fit(Xe)
+
+    def _transform_chunk(self, X, mask, s, executor=None):
+        """
+        Helper function: features of one chunk of preprocessed images X, found at positions s of the input, as a list
+        with one array per extractor.
+        """
+        X = _stack(X)
+        mask = None if mask is None else _stack(mask)
+        cast = {}
+        calls = []
+        for e in self.extractors:
+            dtype = self._input_dtype(e)
+            if dtype is not None and dtype not in cast:
+                cast[dtype] = X.astype(dtype, copy=False)
+            args = (X if dtype is None else cast[dtype],)
+            if type(_unwrap(e)).__name__ in MASKED:
+                # the masks given to the extractor's constructor are used when no chunk mask is available
+                own = getattr(_unwrap(e), "mask", None)
+                args += (mask if mask is not None or own is None else own[s],)
+            calls.append((e.transform, args))
+        if executor is None:
+            return [func(*args) for (func, args) in calls]
+        futures = [executor.submit(func, *args) for (func, args) in calls]
+        return [f.result() for f in futures]
+
+    def _chunks(self, X, mask):
+        """
+        Helper function: yield (slice, images, masks) triples of the preprocessed chunks of X.
+        """
+        if self.preprocessing is None:
+            for s in chunk_slices(len(X), self.chunk_size):
+                yield s, X[s], None if mask is None else mask[s]
+            return
+        # one pool of mask workers is shared by all the chunks
+        with self.preprocessing.pool() as executor:
+            for s in chunk_slices(len(X), self.chunk_size):
+                out = self.preprocessing.process_chunk(X[s], executor)
+                yield s, out[self.image_output], out.get("mask", None if mask is None else mask[s])
+
+    def _transform(self, chunks, n):
+        """
+        Helper function: write the features of the chunks into one (n, n_features) matrix, setting columns_.
+        """
+        features = None
+        executor = make_executor(self.n_jobs, "thread") if effective_n_jobs(self.n_jobs) > 1 else None
+        try:
+            for (s, Xs, ms) in chunks:
+                parts = self._transform_chunk(Xs, ms, s, executor)
+                if features is None:
+                    widths = [np.shape(p)[1] for p in parts]
+                    bounds = np.concatenate([[0], np.cumsum(widths)])
+                    self.columns_ = {name: slice(int(bounds[i]), int(bounds[i + 1]))
+                                     for (i, name) in enumerate(self.names)}
+                    features = np.empty((n, bounds[-1]))
+                for (name, p) in zip(self.names, parts):
+                    features[s, self.columns_[name]] = p
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        if features is None:
+            raise Exception("No images to transform.")
+        return features
+
+    @traced("FeatureUnion.transform")
+    def transform(self, X, mask=None):
+        """
+        Extract the features of every extractor from the images X, chunk_size images at a time.
+        :param X: a list of single-channel arrays or an ndarray with shape (n_samples, H, W), or multi-channel images
+        if a preprocessing pipeline was given.
+        :param mask: optional masks of X for the masked extractors. Ignored if the preprocessing pipeline outputs masks.
+        :return: ndarray with shape (n_samples, n_features). The features of extractor `name` are in the columns
+        columns_[name].
+        """
+        if mask is not None:
+            assert len(X) == len(mask), "Number of source images and number of masks do not equal."
+        return self._transform(self._chunks(X, mask), len(X))
+
+    @traced("FeatureUnion.fit_transform")
+    def fit_transform(self, X, y=None, mask=None):
+        """
+        Combine fit() and transform(), preprocessing the images only once.
+        """
+        if self.preprocessing is not None:
+            out = self.preprocessing.transform(X)
+            X, mask = out[self.image_output], out.get("mask", mask)
+        X = _stack(X)
+        self._fit(X, y)
+        chunks = ((s, X[s], None if mask is None else mask[s]) for s in chunk_slices(len(X), self.chunk_size))
+        return self._transform(chunks, len(X))
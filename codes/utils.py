@@ -2,14 +2,18 @@ import cv2
 import pandas as pd
 import numpy as np
 import os
+import json
+import hashlib
+from .parallel import effective_n_jobs, make_executor, chunk_slices, parallel_map
+from .instrumentation import traced
 
-def load_data():
-    """
-    Loads the train, validation, and test images in 3 separate lists along with 
-    their respective labels.
+SPLITS = ("train", "valid", "test")
+PACK_VERSION = 1
 
-    Results are returned in the form of 3 tuples:
-    (X_train, y_train), (X_valid, y_valid), (X_test, y_test)
+def read_labels():
+    """
+    Switches the working directory to the data directory and imports
+    labels-files.csv, which is used as reference for all image paths.
     """
     # get directory of current file
     file_dir = os.path.dirname(os.path.realpath(__file__))
@@ -17,25 +21,198 @@ def load_data():
     main_dir = os.path.dirname(file_dir)
     os.chdir(main_dir + "/data")
     # import labels-files.csv as reference
-    df = pd.read_csv("labels-files.csv")
-    # initialize image and label lists, along with their start indices
-    X_train, y_train, idx_train = ([None]*65000, np.empty(shape=(65000,), dtype=int), 0)
-    X_valid, y_valid, idx_valid = ([None]*12500, np.empty(shape=(12500,), dtype=int), 0)
-    X_test, y_test, idx_test = ([None]*12500, np.empty(shape=(12500,), dtype=int), 0)
-    for i in range(90000):
-        if df.loc[i,"split"] == "train":
-            X_train[idx_train] = cv2.imread(df.loc[i,"path"])
-            y_train[idx_train] = df.loc[i,"label_idx"]
-            idx_train += 1
-        elif df.loc[i,"split"] == "valid":
-            X_valid[idx_valid] = cv2.imread(df.loc[i,"path"])
-            y_valid[idx_valid] = df.loc[i,"label_idx"]
-            idx_valid += 1
-        else:       # test data
-            X_test[idx_test] = cv2.imread(df.loc[i,"path"])
-            y_test[idx_test] = df.loc[i,"label_idx"]
-            idx_test += 1
-    return (X_train, y_train), (X_valid, y_valid), (X_test, y_test)
+    return pd.read_csv("labels-files.csv")
+
+def split_masks(df):
+    """
+    Computes a boolean mask over the rows of `df` for each data split. Rows
+    that are neither train nor valid are considered as test data.
+    """
+    split = df["split"].to_numpy()
+    is_train = split == "train"
+    is_valid = split == "valid"
+    return {"train": is_train, "valid": is_valid, "test": ~(is_train | is_valid)}
+
+@traced("utils.read_images", items=0)
+def read_images(paths, n_jobs=1, backend="thread"):
+    """
+    Decodes the images in `paths` with cv2.imread and returns them as a list in
+    the same order.
+
+    Inputs:
+    - paths: sequence of image paths
+    - n_jobs: number of workers used for decoding (-1 uses all cores)
+    - backend: "thread" or "process" pool. cv2.imread releases the GIL, so 
+        threads are usually sufficient.
+    """
+    n_workers = effective_n_jobs(n_jobs)
+    chunksize = max(len(paths) // (4*n_workers), 1) if backend == "process" else 1
+    return parallel_map(cv2.imread, paths, n_jobs, backend, chunksize)
+
+@traced("utils.load_data", items=lambda data: sum(len(y) for (_, y) in data))
+def load_data(n_jobs=1, backend="thread"):
+    """
+    Loads the train, validation, and test images in 3 separate lists along with 
+    their respective labels.
+
+    Inputs:
+    - n_jobs: number of workers used for decoding images (-1 uses all cores)
+    - backend: "thread" or "process" pool used for decoding
+
+    Results are returned in the form of 3 tuples:
+    (X_train, y_train), (X_valid, y_valid), (X_test, y_test)
+    """
+    df = read_labels()
+    masks = split_masks(df)
+    # decode every image once, in csv order
+    X_all = read_images(df["path"].tolist(), n_jobs, backend)
+    labels = df["label_idx"].to_numpy().astype(int)
+    data = []
+    for split in SPLITS:
+        idx = np.flatnonzero(masks[split])
+        data.append(([X_all[i] for i in idx], labels[idx]))
+    return tuple(data)
+
+def iter_data(split="train", batch_size=1000, n_jobs=1, backend="thread"):
+    """
+    Lazily loads the images of one data split in fixed-size batches, so that
+    feature extraction can start before the whole split is decoded. While a
+    batch is being consumed, the next one is already decoded in the background.
+
+    Inputs:
+    - split: "train", "valid" or "test"
+    - batch_size: number of images per batch (the last batch may be smaller)
+    - n_jobs: number of workers used for decoding images (-1 uses all cores)
+    - backend: "thread" or "process" pool used for decoding
+
+    Yields tuples (X_batch, y_batch), where X_batch is a list of images and
+    y_batch is an array of labels.
+    """
+    assert split in SPLITS, "split must be one of 'train', 'valid' or 'test'"
+    df = read_labels()
+    idx = np.flatnonzero(split_masks(df)[split])
+    paths = df["path"].to_numpy()[idx]
+    labels = df["label_idx"].to_numpy().astype(int)[idx]
+    batches = chunk_slices(len(paths), batch_size)
+    for (s, X_batch) in zip(batches, _iter_images(paths, batch_size, n_jobs, backend)):
+        yield X_batch, labels[s]
+
+def _iter_images(paths, batch_size, n_jobs=1, backend="thread"):
+    """
+    Decodes `paths` in batches of `batch_size` images. With more than one
+    worker, the next batch is decoded while the current one is consumed.
+    """
+    batches = chunk_slices(len(paths), batch_size)
+    if effective_n_jobs(n_jobs) == 1:
+        for s in batches:
+            yield [cv2.imread(path) for path in paths[s]]
+        return
+    n_workers = effective_n_jobs(n_jobs)
+    chunksize = max(batch_size // (4*n_workers), 1) if backend == "process" else 1
+    with make_executor(n_jobs, backend) as executor:
+        pending = executor.map(cv2.imread, paths[batches[0]], chunksize=chunksize) if batches else None
+        for k in range(len(batches)):
+            X_batch = list(pending)
+            # start decoding the next batch before handing this one out
+            if k + 1 < len(batches):
+                pending = executor.map(cv2.imread, paths[batches[k+1]], chunksize=chunksize)
+            yield X_batch
+
+def _file_checksum(filename):
+    """
+    SHA-256 checksum of a file, read in blocks.
+    """
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def pack_data(pack_dir="packed", batch_size=1000, n_jobs=1, backend="thread"):
+    """
+    One-time conversion of the image files into contiguous uint8 tensors. For
+    each split, the following files are written into data/`pack_dir`:
+    - {split}_X.npy => images, array of shape (N, H, W, C)
+    - {split}_y.npy => labels, array of shape (N,)
+    - {split}_idx.npy => row index of each image in labels-files.csv
+    A manifest.json file records the shapes and the checksum of
+    labels-files.csv, so that a stale pack can be detected by load_packed.
+    The manifest of an existing pack is removed first and the new one is
+    written last, so an interrupted run leaves no pack that load_packed
+    accepts.
+
+    Inputs:
+    - pack_dir: output directory, relative to the data directory
+    - batch_size: number of images decoded and written at a time
+    - n_jobs, backend: worker pool used for decoding (see load_data)
+    """
+    df = read_labels()
+    masks = split_masks(df)
+    paths = df["path"].to_numpy()
+    labels = df["label_idx"].to_numpy().astype(int)
+    shape = cv2.imread(paths[0]).shape
+    os.makedirs(pack_dir, exist_ok=True)
+    manifest_file = os.path.join(pack_dir, "manifest.json")
+    if os.path.exists(manifest_file):
+        os.remove(manifest_file)
+    manifest = {
+        "version": PACK_VERSION,
+        "labels_sha256": _file_checksum("labels-files.csv"),
+        "image_shape": list(shape),
+        "dtype": "uint8",
+        "splits": {}
+    }
+    for split in SPLITS:
+        idx = np.flatnonzero(masks[split])
+        X = np.lib.format.open_memmap(os.path.join(pack_dir, split + "_X.npy"), mode="w+",
+                                      dtype=np.uint8, shape=(len(idx),) + shape)
+        start = 0
+        for X_batch in _iter_images(paths[idx], batch_size, n_jobs, backend):
+            for img in X_batch:
+                assert img is not None and img.shape == shape, "Images do not share the same shape."
+                X[start] = img
+                start += 1
+        X.flush()
+        del X
+        np.save(os.path.join(pack_dir, split + "_y.npy"), labels[idx])
+        np.save(os.path.join(pack_dir, split + "_idx.npy"), idx)
+        manifest["splits"][split] = {"n_samples": int(len(idx))}
+    with open(manifest_file + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_file + ".tmp", manifest_file)
+    return None
+
+def load_packed(pack_dir="packed", mmap_mode="r", check=True):
+    """
+    Loads the train, validation, and test data written by pack_data. Images are
+    memory-mapped rather than read, so loading takes seconds and several worker
+    processes opening the same pack share the pages without copies.
+
+    Inputs:
+    - pack_dir: directory of the pack, relative to the data directory
+    - mmap_mode: mode passed to np.load ("r" for read-only, None reads the 
+        arrays into memory)
+    - check: whether to verify the pack against the current labels-files.csv
+
+    Results are returned in the form of 3 tuples, as in load_data, where the
+    images are arrays of shape (N, H, W, C):
+    (X_train, y_train), (X_valid, y_valid), (X_test, y_test)
+    """
+    read_labels()
+    manifest_file = os.path.join(pack_dir, "manifest.json")
+    if not os.path.exists(manifest_file):
+        raise Exception("No packed data found in data/" + pack_dir + ", run pack_data() first!")
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+    if check and (manifest.get("version") != PACK_VERSION or 
+                  manifest["labels_sha256"] != _file_checksum("labels-files.csv")):
+        raise Exception("Packed data is stale, run pack_data() again!")
+    data = []
+    for split in SPLITS:
+        X = np.load(os.path.join(pack_dir, split + "_X.npy"), mmap_mode=mmap_mode)
+        y = np.load(os.path.join(pack_dir, split + "_y.npy"))
+        data.append((X, y))
+    return tuple(data)
 
 def get_channel(X, channel):
     """
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# make the codes package and the helper scripts of this directory importable
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+for path in (ROOT, os.path.dirname(os.path.realpath(__file__))):
+    if path not in sys.path:
+        sys.path.insert(0, path)
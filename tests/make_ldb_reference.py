@@ -0,0 +1,54 @@
+"""
+Generate the reference outputs of the Julia LDB backend (LDB_FeatureExtractor) used by test_numpy_ldb.py to check
+the NumPy backend (NumpyLDB_FeatureExtractor). Needs Julia and PyJulia (see the Setup section of the README):
+
+    python tests/make_ldb_reference.py
+
+The features, best basis tree, discriminant power and its ordering of every configuration in CONFIGS are written
+to tests/data/ldb_reference.npz, under keys prefixed with the configuration name.
+"""
+import os
+import numpy as np
+
+REFERENCE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "data", "ldb_reference.npz")
+
+# name -> (wt, dm, en, dp, n_features) of both backends. Non-haar wavelets check the filter conventions of PyWavelets
+# against those of Wavelets.jl
+CONFIGS = {"default": ("haar", "AsymmetricRelativeEntropy", "TimeFrequency", "BasisDiscriminantMeasure", 20),
+           "symmetric_fisher": ("haar", "SymmetricRelativeEntropy", "TimeFrequency", "FishersClassSeparability", 20),
+           "hellinger": ("haar", "HellingerDistance", "TimeFrequency", "BasisDiscriminantMeasure", 20),
+           "density": ("haar", "AsymmetricRelativeEntropy", "ProbabilityDensity", "BasisDiscriminantMeasure", 20),
+           "db2": ("db2", "AsymmetricRelativeEntropy", "TimeFrequency", "BasisDiscriminantMeasure", 20),
+           "sym4": ("sym4", "AsymmetricRelativeEntropy", "TimeFrequency", "BasisDiscriminantMeasure", 20)}
+
+def signals(n=60, size=16, n_classes=3, seed=0):
+    """
+    Fixed test set: n images of size x size pixels (signals of length size**2) with class-dependent textures, and
+    their labels.
+    """
+    rng = np.random.default_rng(seed)
+    y = np.arange(n) % n_classes + 1
+    yy, xx = np.mgrid[:size, :size]
+    X = rng.normal(0, 1, (n, size, size))
+    for (i, c) in enumerate(y):
+        X[i] += 3 * np.sin(2 * np.pi * c * (xx + yy) / size + rng.uniform(0, 2 * np.pi))
+    return X, y
+
+def main():
+    from codes.ldb import LDB_FeatureExtractor, julia_main
+    Main = julia_main()
+    X, y = signals()
+    arrays = {}
+    for (name, (wt, dm, en, dp, n_features)) in CONFIGS.items():
+        ldb = LDB_FeatureExtractor(wt=Main.wavelet(getattr(Main.WT, wt)), dm=getattr(Main, dm)(), en=getattr(Main, en)(), dp=getattr(Main, dp)(),
+                                   n_features=n_features)
+        features = np.array(ldb.fit_transform(X, y))
+        arrays[name + "/features"] = features
+        arrays[name + "/tree"] = np.array(ldb.tree, dtype=bool)
+        arrays[name + "/DP"] = np.array(ldb.DP)
+        arrays[name + "/order"] = np.array(ldb.order)
+    os.makedirs(os.path.dirname(REFERENCE), exist_ok=True)
+    np.savez(REFERENCE, **arrays)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+from codes.feature_cache import FeatureCache, CachedExtractor, extractor_key
+from codes.ldb import NumpyLDB_FeatureExtractor
+
+def _signals(seed):
+    rng = np.random.default_rng(seed)
+    y = np.repeat([0, 1], 20)
+    X = rng.normal(size=(40, 8, 8)) + y[:, None, None] * rng.normal(size=(8, 8))
+    return X, y
+
+def test_refitted_ldb_is_not_served_stale_rows(tmp_path):
+    X1, y1 = _signals(0)
+    X2, y2 = _signals(1)
+    ldb = NumpyLDB_FeatureExtractor(n_features=10)
+    cached = CachedExtractor(ldb, FeatureCache(str(tmp_path / "cache.sqlite")))
+    cached.fit(X1, y1)
+    key = extractor_key(ldb)
+    cached.transform(X1)
+    cached.fit(X2, y2)
+    assert extractor_key(ldb) != key
+    np.testing.assert_allclose(cached.transform(X1), ldb.transform(X1))
+
+def test_unlisted_extractor_is_rejected(tmp_path):
+    class Unknown:
+        def transform(self, X):
+            return np.zeros((len(X), 1))
+    with pytest.raises(AssertionError):
+        CachedExtractor(Unknown(), FeatureCache(str(tmp_path / "cache.sqlite")))
@@ -0,0 +1,28 @@
+import mahotas as mh
+import numpy as np
+import pytest
+from benchmarks.run_benchmarks import synthetic_images
+from codes.haralick import haralick, _quantize
+from codes.image_preprocessing import preprocessing_pipeline
+
+@pytest.fixture(scope="module")
+def images():
+    X, _ = synthetic_images(12, seed=4, size=32)
+    return preprocessing_pipeline(option="ROI").transform(X)["normalized"]
+
+def _mahotas(X, distance, ignore_zeros):
+    return np.array([np.concatenate([mh.features.haralick(img, ignore_zeros=ignore_zeros, distance=s).ravel()
+                                     for s in distance]) for img in X])
+
+@pytest.mark.parametrize("engine", ["mahotas", "numpy"])
+@pytest.mark.parametrize("ignore_zeros", [True, False])
+def test_matches_mahotas(images, engine, ignore_zeros):
+    features = haralick([1, 3], ignore_zeros=ignore_zeros, engine=engine).transform(images)
+    np.testing.assert_allclose(features, _mahotas(images, [1, 3], ignore_zeros), rtol=1e-10, atol=1e-12)
+
+def test_numpy_engine_quantized_and_16bit(images):
+    features = haralick([2], engine="numpy", levels=32).transform(images)
+    np.testing.assert_allclose(features, _mahotas(_quantize(images, 32), [2], True), rtol=1e-10, atol=1e-12)
+    wide = images.astype(np.uint16) * 4
+    features = haralick([1], engine="numpy").transform(wide)
+    np.testing.assert_allclose(features, _mahotas(wide, [1], True), rtol=1e-10, atol=1e-12)
@@ -0,0 +1,19 @@
+import numpy as np
+import pytest
+from benchmarks.run_benchmarks import synthetic_images
+from codes.image_preprocessing import image_preprocessing
+
+def test_batched_normalize_matches_list():
+    X, _ = synthetic_images(10, seed=3, size=32)
+    P = image_preprocessing()
+    P.split_channels(X)
+    P.ROI()
+    for option in ('whole', 'ROI', 'ROI_on_whole'):
+        batched = P.image_normalize(option, src=np.stack(P.img), mask=np.stack(P.mask))
+        listed = P.image_normalize(option, src=list(P.img), mask=list(P.mask))
+        np.testing.assert_array_equal(batched, np.stack(listed))
+
+def test_batched_normalize_rejects_other_dtypes():
+    X = np.random.default_rng(0).random((4, 16, 16)).astype(np.float32)
+    with pytest.raises(AssertionError):
+        image_preprocessing().image_normalize('whole', src=X)
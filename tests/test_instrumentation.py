@@ -0,0 +1,10 @@
+import numpy as np
+from codes.instrumentation import current_rss, peak_rss
+
+def test_peak_rss_sees_transient_allocations():
+    size = max(peak_rss() - current_rss(), 0) + (256 << 20)
+    before = peak_rss()
+    # touched and freed before the peak is read again
+    np.ones(size, dtype=np.uint8).sum()
+    assert peak_rss() - before >= (128 << 20)
+    assert peak_rss() >= current_rss()
@@ -0,0 +1,39 @@
+import cv2
+import numpy as np
+import pytest
+from benchmarks.run_benchmarks import synthetic_images
+from codes.image_preprocessing import preprocessing_pipeline
+from codes.intensity import IntensityMeasure
+
+@pytest.fixture(scope="module")
+def images():
+    X, _ = synthetic_images(25, seed=6, size=32)
+    out = preprocessing_pipeline(outputs=("normalized", "mask")).transform(X)
+    return out["normalized"], out["mask"]
+
+def _centroid(img, binary):
+    M = cv2.moments(img, binaryImage=binary)
+    return int(M["m10"] / M["m00"]), int(M["m01"] / M["m00"])
+
+def _reference(X, mask=None):
+    # per-image measurements, as the features were first defined
+    rows = []
+    for (i, img) in enumerate(X):
+        roi = img if mask is None else img[mask[i] != 0]
+        row = [np.mean(roi), np.std(roi), np.min(roi), np.max(roi)]
+        if mask is not None:
+            img_ = img.copy()
+            img_[mask[i] == 0] = 0
+            (X_bi, Y_bi), (X_gy, Y_gy) = _centroid(img_, True), _centroid(img_, False)
+            row.append(((X_bi - X_gy) ** 2 + (Y_bi - Y_gy) ** 2) ** 0.5)
+        rows.append(row)
+    return np.array(rows)
+
+def test_matches_reference(images):
+    im, mask = images
+    np.testing.assert_allclose(IntensityMeasure(chunk_size=10).fit_transform(im), _reference(im),
+                               rtol=1e-10, atol=1e-10)
+    np.testing.assert_allclose(IntensityMeasure(mask, chunk_size=10).fit_transform(im), _reference(im, mask),
+                               rtol=1e-10, atol=1e-10)
+    np.testing.assert_allclose(IntensityMeasure().transform(list(im), list(mask)), _reference(im, mask),
+                               rtol=1e-10, atol=1e-10)
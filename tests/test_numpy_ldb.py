@@ -0,0 +1,20 @@
+import os
+import numpy as np
+import pytest
+from codes.ldb import NumpyLDB_FeatureExtractor
+from make_ldb_reference import CONFIGS, REFERENCE, signals
+
+pytestmark = pytest.mark.skipif(not os.path.exists(REFERENCE),
+                                reason="Julia reference not generated, run tests/make_ldb_reference.py")
+
+@pytest.mark.parametrize("name", sorted(CONFIGS))
+def test_matches_julia_backend(name):
+    wt, dm, en, dp, n_features = CONFIGS[name]
+    X, y = signals()
+    ldb = NumpyLDB_FeatureExtractor(wt=wt, dm=dm, en=en, dp=dp, n_features=n_features)
+    features = ldb.fit_transform(X, y)
+    with np.load(REFERENCE) as ref:
+        np.testing.assert_array_equal(ldb.tree, ref[name + "/tree"])
+        np.testing.assert_allclose(ldb.DP, ref[name + "/DP"], rtol=1e-8, atol=1e-10)
+        np.testing.assert_array_equal(ldb.order[:n_features], ref[name + "/order"][:n_features])
+        np.testing.assert_allclose(features, ref[name + "/features"], rtol=1e-8, atol=1e-10)
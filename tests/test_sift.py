@@ -0,0 +1,16 @@
+import numpy as np
+from sklearn.cluster import KMeans
+from benchmarks.run_benchmarks import synthetic_images
+from codes.sift import SIFT_FeatureExtractor, nearest_centroid
+
+def test_nearest_centroid_matches_kmeans_predict():
+    X, _ = synthetic_images(60, seed=7, size=64)
+    des, _ = SIFT_FeatureExtractor().extract_descriptors(X[..., 1])
+    kmeans = KMeans(n_clusters=20, random_state=0, n_init=1).fit(des.astype(np.float64))
+    expected = kmeans.predict(des.astype(np.float64))
+    labs = nearest_centroid(des, kmeans.cluster_centers_, chunk_size=100)
+    # float32 distances may only break exact ties differently
+    d = ((des[:, None, :].astype(np.float64) - kmeans.cluster_centers_[None]) ** 2).sum(axis=2)
+    rows = np.arange(len(des))
+    np.testing.assert_allclose(d[rows, labs], d[rows, expected], rtol=1e-5)
+    assert (labs == expected).mean() > 0.999
@@ -0,0 +1,40 @@
+import types
+import numpy as np
+from benchmarks.run_benchmarks import synthetic_images
+from codes import sweep as sweep_module
+from codes.sift import SIFT_FeatureExtractor
+from codes.sweep import FeatureSweep
+from codes.swt import SWT_FeatureExtractor
+
+def _images(n):
+    X, _ = synthetic_images(n, seed=2, size=32)
+    return X[..., 1]
+
+def test_swt_levels_match_refits():
+    X = _images(20)
+    features = FeatureSweep({"swt": {"n_levels": [1, 2, 3]}}, probe_size=0).run(X)["swt"]
+    for n in (1, 2, 3):
+        np.testing.assert_allclose(features[n], SWT_FeatureExtractor(n_levels=n).transform(X), rtol=1e-12, atol=1e-10)
+
+def test_sift_codebook_larger_than_one_image():
+    # the first probe image has fewer descriptors than the largest codebook, so it cannot be refitted alone
+    X = _images(40)
+    sweep = FeatureSweep({"sift": {"kmeans_nclusters": [5, 20], "random_state": 0}}, probe_size=20, random_state=0)
+    features = sweep.run(X)["sift"]
+    for k in (5, 20):
+        np.testing.assert_allclose(features[k], SIFT_FeatureExtractor(kmeans_nclusters=k, random_state=0)
+                                   .fit_transform(X))
+    assert sweep.report()["sift"]["estimated_naive_time"] > 0
+
+def test_naive_time_separates_fixed_cost(monkeypatch):
+    # refits with a known cost on a fake clock: 2 s fixed plus 0.01 s per image for each grid point
+    clock = [0.]
+    def point(X, value, kwargs):
+        clock[0] += 2. + 0.01 * len(X)
+    monkeypatch.setattr(sweep_module, "time", types.SimpleNamespace(perf_counter=lambda: clock[0]))
+    monkeypatch.setitem(sweep_module.SWEEPS, "swt", ("n_levels", sweep_module.swt_levels, point))
+    sweep = FeatureSweep({"swt": {"n_levels": [1, 2, 3]}}, probe_size=30, random_state=0)
+    X = np.zeros((1000, 8, 8))
+    np.testing.assert_allclose(sweep._naive_time(X, "swt", [1, 2, 3], {}), 3 * (2. + 0.01 * 1000))
+    # a probe covering all the images is the measured time
+    np.testing.assert_allclose(sweep._naive_time(X[:20], "swt", [1, 2, 3], {}), 3 * (2. + 0.01 * 20))
@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+import pywt
+from scipy.fftpack import dct
+from benchmarks.run_benchmarks import synthetic_images
+from codes.swt import SWT_FeatureExtractor
+
+def _reference(X, wt, n_levels):
+    # one SWT and full DCTs per image, as the features were first defined
+    Xt = np.empty((len(X), 192 * n_levels))
+    for (i, img) in enumerate(X):
+        _, *Xw = pywt.swt2(img, wt, n_levels, start_level=0, trim_approx=True)
+        counter = 0
+        for detail_coefs in Xw:
+            for mat in detail_coefs:
+                dmat = dct(dct(mat, 2, axis=0, norm="ortho"), 2, axis=1, norm="ortho")
+                Xt[i, counter:(counter + 64)] = dmat[::8, ::8].reshape(-1)
+                counter += 64
+    return Xt
+
+@pytest.mark.parametrize("wt,n_levels", [("haar", 1), ("haar", 3), ("db2", 2)])
+def test_matches_reference(wt, n_levels):
+    X, _ = synthetic_images(7, seed=5, size=64)
+    X = X[..., 1]
+    expected = _reference(X.astype(np.float64), wt, n_levels)
+    extractor = SWT_FeatureExtractor(wt, n_levels, batch_size=3)
+    np.testing.assert_allclose(extractor.transform(X), expected, rtol=1e-10, atol=1e-9)
+    np.testing.assert_allclose(extractor.transform(list(X)), expected, rtol=1e-10, atol=1e-9)
+
+def test_empty_input():
+    assert SWT_FeatureExtractor(n_levels=2).transform(np.empty((0, 64, 64))).shape == (0, 384)
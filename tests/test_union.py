@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+from benchmarks.run_benchmarks import synthetic_images
+from codes.feature_cache import FeatureCache, CachedExtractor
+from codes.image_preprocessing import preprocessing_pipeline
+from codes.intensity import IntensityMeasure
+from codes.scattering_transform import scattering_transform
+from codes.swt import SWT_FeatureExtractor
+from codes.union import FeatureUnion
+
+@pytest.fixture(scope="module")
+def images():
+    X, _ = synthetic_images(70, seed=1, size=32)
+    out = preprocessing_pipeline(outputs=("normalized", "mask")).transform(X)
+    return out["normalized"], out["mask"]
+
+def _members(mask, cache):
+    return [CachedExtractor(IntensityMeasure(mask), cache),
+            CachedExtractor(scattering_transform(1, mask.shape[1:], L=4, stats=("mean", "roi_mean"),
+                                                 backend="thread", mask=mask), cache),
+            SWT_FeatureExtractor()]
+
+@pytest.mark.parametrize("n_jobs", [1, 2])
+def test_cached_members_match_direct_extractors(images, tmp_path, n_jobs):
+    im, mask = images
+    direct = [IntensityMeasure(mask).transform(im),
+              scattering_transform(1, im.shape[1:], L=4, stats=("mean", "roi_mean"), backend="thread")
+              .transform(im.astype(np.float64), mask),
+              SWT_FeatureExtractor().transform(im)]
+    cache = FeatureCache(str(tmp_path / "cache.sqlite"))
+    union = FeatureUnion(_members(mask, cache), names=["intensity", "scattering", "swt"], chunk_size=30,
+                         n_jobs=n_jobs)
+    for _ in range(2):
+        # the second pass reads every row from the cache
+        features = union.fit_transform(im)
+        for (name, expected) in zip(union.names, direct):
+            np.testing.assert_allclose(features[:, union.columns_[name]], expected, rtol=1e-12, atol=1e-12)
+    assert cache.report()["hits"] == 2 * len(im)
+
+def test_chunk_masks_from_preprocessing(images):
+    im, mask = images
+    X, _ = synthetic_images(70, seed=1, size=32)
+    union = FeatureUnion([IntensityMeasure()], preprocessing=preprocessing_pipeline(outputs=("normalized", "mask")),
+                         chunk_size=30)
+    np.testing.assert_allclose(union.fit_transform(X), IntensityMeasure(mask).transform(im))
+
+def test_data_free_fits_are_not_cast(images, monkeypatch):
+    # SWT and scattering fits do not read the images, so the whole dataset must not be cast to float64 for them
+    im, _ = images
+    fitted = []
+    monkeypatch.setattr(SWT_FeatureExtractor, "fit", lambda self, X=None, y=None: fitted.append(X.dtype))
+    members = [SWT_FeatureExtractor(), scattering_transform(1, im.shape[1:], L=4, backend="thread")]
+    union = FeatureUnion(members, names=["swt", "scattering"], chunk_size=30)
+    features = union.fit_transform(im)
+    assert fitted == [np.uint8]
+    np.testing.assert_allclose(features[:, union.columns_["swt"]], SWT_FeatureExtractor().transform(im))